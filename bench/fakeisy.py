@@ -0,0 +1,112 @@
+# = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = #
+#                                                                             #
+# fakeisy.py - a single-threaded, non-blocking stand-in for the ISY REST API  #
+#                                                                             #
+# = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = #
+#
+# Accepts the node server's reports, records each request path with the
+# time it arrived, and answers "200 OK" with an empty body.  Keep-alive is
+# honoured unless the request asks for "Connection: close" or is HTTP/1.0.
+# An optional delay holds every response back to simulate a slow ISY.
+#
+# = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = #
+
+import usocket as socket
+import utime as time
+
+_OK_KEEP = b"HTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\n"
+_OK_CLOSE = b"HTTP/1.1 200 OK\r\nContent-Length: 0\r\nConnection: close\r\n\r\n"
+
+class _Conn():
+
+    sock = None
+    ibuf = b""
+    obuf = b""
+    due = 0
+    close = False
+
+    def __init__(self, sock):
+        self.sock = sock
+
+class FakeISY():
+
+    log = None          # [(ticks_us, path), ...]
+    delay_ms = 0
+
+    _sock = None
+    _conns = None
+
+    def __init__(self, port, delay_ms=0):
+        self.log = []
+        self.delay_ms = delay_ms
+        self._conns = []
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind(socket.getaddrinfo("0.0.0.0", port)[0][-1])
+        self._sock.listen(4)
+        self._sock.setblocking(False)
+
+    def close(self):
+        for c in self._conns:
+            c.sock.close()
+        self._conns = []
+        self._sock.close()
+
+    def run(self):
+        have_work = False
+        try:
+            s, addr = self._sock.accept()
+            s.setblocking(False)
+            self._conns.append(_Conn(s))
+            have_work = True
+        except OSError:
+            pass
+
+        for c in self._conns[:]:
+            have_work = self._service(c) or have_work
+        return have_work
+
+    def _service(self, c):
+        have_work = False
+        if not c.obuf:
+            try:
+                d = c.sock.recv(512)
+            except OSError:
+                d = None
+            if d is not None:
+                if not d:
+                    self._drop(c)
+                    return True
+                c.ibuf += d
+                have_work = True
+            self._parse(c)
+
+        if c.obuf and time.ticks_diff(time.ticks_ms(), c.due) >= 0:
+            try:
+                n = c.sock.send(c.obuf)
+            except OSError:
+                n = 0
+            c.obuf = c.obuf[n:]
+            have_work = have_work or n > 0
+            if not c.obuf and c.close:
+                self._drop(c)
+        return have_work
+
+    def _parse(self, c):
+        i = c.ibuf.find(b"\r\n\r\n")
+        if i < 0:
+            return
+        head = c.ibuf[:i]
+        c.ibuf = c.ibuf[i + 4:]
+        line = head.split(b"\r\n", 1)[0].split(b" ")
+        self.log.append((time.ticks_us(), line[1]))
+        c.close = (line[2] == b"HTTP/1.0" or
+                   b"connection: close" in head.lower())
+        c.obuf = _OK_CLOSE if c.close else _OK_KEEP
+        c.due = time.ticks_add(time.ticks_ms(), self.delay_ms)
+
+    def _drop(self, c):
+        c.sock.close()
+        self._conns.remove(c)
+
+# = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = #
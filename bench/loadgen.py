@@ -0,0 +1,128 @@
+# = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = #
+#                                                                             #
+# loadgen.py - non-blocking HTTP load generator for the node server           #
+#                                                                             #
+# = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = #
+#
+# Plays the ISY's side of the node server API: queued paths are sent as
+# GETs, "pipeline" of them back to back on each connection, with at most
+# "conns" connections open.  The last request on a connection asks the
+# server to close it.  The latency of a request runs from connect() to
+# the server closing the connection after its response.
+#
+# = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = #
+
+import usocket as socket
+import utime as time
+
+class _Rqst():
+
+    sock = None
+    count = 0
+    obuf = b""
+    start = 0
+    ibuf = b""
+
+class LoadGen():
+
+    latency = None      # [us, ...] of completed requests
+    errors = 0
+    statuses = None     # {status: count}
+
+    _addr = None
+    _conns = 1
+    _pipeline = 1
+    _queue = None
+    _active = None
+    _hdr = None
+
+    def __init__(self, host, port, conns=1, pipeline=1):
+        self._addr = socket.getaddrinfo(host, port)[0][-1]
+        self._conns = conns
+        self._pipeline = pipeline
+        self._hdr = (b" HTTP/1.1\r\nHost: " + host +
+                     b"\r\nAuthorization: Basic YmVuY2g6YmVuY2g=\r\n")
+        self.reset()
+
+    def reset(self):
+        self.latency = []
+        self.errors = 0
+        self.statuses = {}
+        self._queue = []
+        self._active = []
+
+    def add(self, path):
+        self._queue.append(path)
+
+    def pending(self):
+        return len(self._queue) + len(self._active)
+
+    def run(self):
+        have_work = False
+        while self._queue and len(self._active) < self._conns:
+            paths = self._queue[:self._pipeline]
+            del self._queue[:self._pipeline]
+            self._start(paths)
+            have_work = True
+        for r in self._active[:]:
+            have_work = self._service(r) or have_work
+        return have_work
+
+    def _start(self, paths):
+        r = _Rqst()
+        r.count = len(paths)
+        for i in range(r.count):
+            r.obuf += b"GET " + paths[i] + self._hdr
+            if i == r.count - 1:
+                r.obuf += b"Connection: close\r\n"
+            r.obuf += b"\r\n"
+        r.start = time.ticks_us()
+        r.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        r.sock.setblocking(False)
+        try:
+            r.sock.connect(self._addr)
+        except OSError as e:
+            if e.args[0] not in (11, 115):
+                self._done(r, False)
+                return
+        self._active.append(r)
+
+    def _service(self, r):
+        if r.obuf:
+            try:
+                n = r.sock.send(r.obuf)
+            except OSError as e:
+                if e.args[0] in (11, 107, 115):
+                    return False
+                self._done(r, False)
+                return True
+            r.obuf = r.obuf[n:]
+            return True
+        try:
+            d = r.sock.recv(512)
+        except OSError as e:
+            if e.args[0] == 11:
+                return False
+            self._done(r, False)
+            return True
+        if d is None:
+            return False
+        if d:
+            r.ibuf += d
+            return True
+        self._done(r, r.ibuf.startswith(b"HTTP/"))
+        return True
+
+    def _done(self, r, ok):
+        r.sock.close()
+        if r in self._active:
+            self._active.remove(r)
+        resp = r.ibuf.split(b"HTTP/1.1 ")[1:] if ok else []
+        self.errors += r.count - len(resp)
+        us = time.ticks_diff(time.ticks_us(), r.start)
+        for p in resp:
+            self.latency.append(us)
+            s = int(p[0:3])
+            self.statuses[s] = self.statuses.get(s, 0) + 1
+
+# = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = #
@@ -0,0 +1,23 @@
+# fake_dht.py - a DHT11 that returns fixed readings, optionally taking as
+# long to measure() as the real sensor does
+
+import utime as time
+
+class DHT11():
+
+    delay_ms = 0        # time measure() blocks for
+    temp = 21
+    hum = 40
+
+    def __init__(self, pin):
+        pass
+
+    def measure(self):
+        if self.delay_ms:
+            time.sleep_ms(self.delay_ms)
+
+    def temperature(self):
+        return self.temp
+
+    def humidity(self):
+        return self.hum
@@ -0,0 +1,66 @@
+# fake_machine.py - just enough of machine.Pin and machine.PWM to run the
+# device code off-target.  Input pins can be driven from the benchmark
+# with set(); edges call the registered IRQ handler.
+
+def disable_irq():
+    return 0
+
+def enable_irq(state):
+    pass
+
+class Pin():
+
+    IN = 0
+    OUT = 1
+    PULL_UP = 1
+    IRQ_FALLING = 1
+    IRQ_RISING = 2
+
+    _id = None
+    _value = 0
+    _trigger = 0
+    _handler = None
+
+    def __init__(self, id, mode=-1, pull=-1):
+        self._id = id
+        self._value = 1 if pull == Pin.PULL_UP else 0
+
+    def value(self, v=None):
+        if v is None:
+            return self._value
+        self._value = 1 if v else 0
+
+    def irq(self, handler=None, trigger=IRQ_FALLING | IRQ_RISING):
+        self._handler = handler
+        self._trigger = trigger
+
+    def set(self, v):
+        # Drive an input pin from outside, as the hardware would
+        v = 1 if v else 0
+        if v == self._value:
+            return
+        self._value = v
+        edge = Pin.IRQ_RISING if v else Pin.IRQ_FALLING
+        if self._handler is not None and self._trigger & edge:
+            self._handler(self)
+
+class PWM():
+
+    _pin = None
+    _freq = 0
+    _duty = 0
+
+    def __init__(self, pin, freq=0, duty=0):
+        self._pin = pin
+        self._freq = freq
+        self._duty = duty
+
+    def duty(self, d=None):
+        if d is None:
+            return self._duty
+        self._duty = d
+
+    def freq(self, f=None):
+        if f is None:
+            return self._freq
+        self._freq = f
@@ -0,0 +1,10 @@
+# fake_micropython.py - the micropython module, for CPython
+
+def const(x):
+    return x
+
+def schedule(f, arg):
+    f(arg)
+
+def alloc_emergency_exception_buf(n):
+    pass
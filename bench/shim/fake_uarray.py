@@ -0,0 +1,3 @@
+# fake_uarray.py - uarray for CPython
+
+from array import array
@@ -0,0 +1,3 @@
+# fake_uos.py - uos for CPython
+
+from os import *
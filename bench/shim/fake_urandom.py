@@ -0,0 +1,3 @@
+# fake_urandom.py - urandom for CPython
+
+from random import getrandbits, randint, random
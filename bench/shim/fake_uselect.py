@@ -0,0 +1,29 @@
+# fake_uselect.py - uselect for CPython.  MicroPython's poll() returns
+# the registered objects themselves; CPython's returns file descriptors,
+# so map them back.
+
+import select as _select
+from select import POLLIN, POLLOUT, POLLERR, POLLHUP
+
+class _Poll():
+
+    def __init__(self):
+        self._p = _select.poll()
+        self._objs = {}
+
+    def register(self, obj, mask=POLLIN | POLLOUT):
+        self._objs[obj.fileno()] = obj
+        self._p.register(obj, mask)
+
+    def modify(self, obj, mask):
+        self._p.modify(obj, mask)
+
+    def unregister(self, obj):
+        self._objs.pop(obj.fileno(), None)
+        self._p.unregister(obj)
+
+    def poll(self, timeout=-1):
+        return [(self._objs[fd], ev) for fd, ev in self._p.poll(timeout)]
+
+def poll():
+    return _Poll()
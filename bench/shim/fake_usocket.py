@@ -0,0 +1,3 @@
+# fake_usocket.py - usocket for CPython, from the standard socket module
+
+from socket import *
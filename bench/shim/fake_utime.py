@@ -0,0 +1,27 @@
+# fake_utime.py - the MicroPython utime tick functions, for CPython
+
+import time as _time
+
+_PERIOD = 1 << 30
+
+def ticks_ms():
+    return int(_time.monotonic() * 1000) & (_PERIOD - 1)
+
+def ticks_us():
+    return int(_time.monotonic() * 1000000) & (_PERIOD - 1)
+
+def ticks_add(t, delta):
+    return (t + delta) & (_PERIOD - 1)
+
+def ticks_diff(t1, t2):
+    d = (t1 - t2) & (_PERIOD - 1)
+    return d - _PERIOD if d >= (_PERIOD >> 1) else d
+
+def sleep_ms(n):
+    _time.sleep(n / 1000)
+
+def sleep_us(n):
+    _time.sleep(n / 1000000)
+
+def time():
+    return int(_time.time())
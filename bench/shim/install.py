@@ -0,0 +1,33 @@
+# install.py - fill in the MicroPython modules the host lacks from the shims
+#
+# Used by bench/unsbench.py and the tests.  Modules the host really has
+# are used as is.  Adds this directory to sys.path if needed.
+
+import sys
+
+_here = __file__.rsplit("/", 1)[0] if "/" in __file__ else "."
+if _here not in sys.path:
+    sys.path.append(_here)
+
+# Real module, the attribute it must have, and the shim to use instead
+_SHIMS = (("usocket", "socket", "fake_usocket"),
+          ("utime", "ticks_ms", "fake_utime"),
+          ("uselect", "poll", "fake_uselect"),
+          ("urandom", "getrandbits", "fake_urandom"),
+          ("uarray", "array", "fake_uarray"),
+          ("ustruct", "pack_into", "struct"),
+          ("uos", "rename", "fake_uos"),
+          ("micropython", "const", "fake_micropython"),
+          ("machine", "PWM", "fake_machine"),
+          ("dht", "DHT11", "fake_dht"))
+
+def install():
+    for name, attr, shim in _SHIMS:
+        try:
+            ok = hasattr(__import__(name), attr)
+        except ImportError:
+            ok = False
+        if not ok:
+            sys.modules[name] = __import__(shim)
+
+install()
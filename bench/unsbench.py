@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+
+# = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = #
+#                                                                             #
+# unsbench.py - host-side benchmark for the micro-node-server                 #
+#                                                                             #
+# = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = #
+#
+# Runs the real server, client, node and scheduler code in one loop, as
+# unsmain.py does on the device, against a local fake ISY and a load
+# generator.  Works under CPython or the MicroPython unix port:
+#
+#   python3 bench/unsbench.py [slots]
+#   micropython -X heapsize=4M bench/unsbench.py [slots]
+#
+# Modules the host lacks (usocket, utime, machine, dht, ...) are filled in
+# from bench/shim; anything the host really has is used as is.  For each
+# scenario it reports throughput, p50/p99 request latency, allocations per
+# request made by the node server code, and how long the report queue took
+# to drain to the ISY once the last response was sent.  Allocations are
+# bytes on MicroPython (gc disabled for the run) and net blocks on CPython,
+# so compare like with like.  slots is the number of requests the client
+# keeps in flight to the ISY (default 1).
+#
+# = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = #
+
+import gc
+import sys
+
+_here = __file__.rsplit("/", 1)[0] if "/" in __file__ else "."
+sys.path.insert(0, _here + "/..")
+sys.path.append(_here + "/shim")
+sys.path.append(_here)
+
+import install
+
+# CPython has no MicroPython heap accounting
+_MPY = hasattr(gc, "mem_alloc")
+if not _MPY:
+    gc.mem_free = lambda: 1 << 20
+    gc.mem_alloc = lambda: 0
+    gc.threshold = lambda n=None: -1
+
+import utime as time
+from unslib import *
+from unsnode import *
+from unsio import *
+from unssched import *
+from unssensor import *
+from unsstats import *
+from unstrace import *
+from fakeisy import FakeISY
+from loadgen import LoadGen
+
+PORT = 18300
+ISY_PORT = 18380
+ADDR = b"n003_esp"
+
+# = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = #
+
+def _allocated():
+    if _MPY:
+        return gc.mem_alloc()
+    return sys.getallocatedblocks()
+
+def _pct(v, p):
+    if not v:
+        return 0
+    return v[min(len(v) - 1, len(v) * p // 100)]
+
+class Bench():
+
+    allocs = 0
+
+    def __init__(self, maxconn=4, keepalive=True, isy_delay=0, conns=4,
+                 slots=1):
+        self.ioq = RingQueue(64)
+        self.restq = ReportQueue(b"/rest/ns/3", batch=1, high=32)
+        self.stats = Stats()
+        self.trace = Trace(128, on=True)    # as unsmain.py runs it
+        self.sched = Scheduler()
+        self.budget = Budget(self.ioq, self.restq, stats=self.stats)
+        self.sensors = Sensors(self.sched, stats=self.stats)
+        self.io = HandleIO(self.ioq, self.restq, self.sched, self.sensors,
+                           trace=self.trace)
+        self.server = StateMachineServer(self.ioq, PORT, maxconn=maxconn,
+                                         poller=self.sched.poller(),
+                                         overloaded=self.budget.overloaded,
+                                         stats=self.stats, trace=self.trace)
+        self.isy = FakeISY(ISY_PORT, isy_delay)
+        self.client = StateMachineClient(self.restq, b"127.0.0.1",
+                                         b"127.0.0.1", ISY_PORT,
+                                         b"YmVuY2g6YmVuY2g=",
+                                         keepalive=keepalive, slots=slots,
+                                         poller=self.sched.poller(),
+                                         stats=self.stats, trace=self.trace)
+        self.load = LoadGen(b"127.0.0.1", PORT, conns)
+        self.pipe = LoadGen(b"127.0.0.1", PORT, 1, pipeline=10)
+
+    def close(self):
+        self.isy.close()
+
+    def step(self):
+        # One pass of the unsmain.py loop, with only its allocations counted
+        a = _allocated()
+        self.budget.plan(self.server.active())
+        busy = self.server.run(limit=self.budget.server)
+        busy = self.client.run(limit=self.budget.client) or busy
+        busy = self.io.run(limit=self.budget.io) or busy
+        busy = self.sched.run() or busy
+        if not busy:
+            busy = self.sensors.sample()
+        self.allocs += _allocated() - a
+
+        busy = self.load.run() or busy
+        busy = self.pipe.run() or busy
+        busy = self.isy.run() or busy
+        if not busy:
+            time.sleep_ms(0)
+
+    def drained(self):
+        return not self.ioq and self.client.idle()
+
+    def settle(self, ms=200):
+        t = time.ticks_ms()
+        while (not self.drained() or
+               time.ticks_diff(time.ticks_ms(), t) < ms):
+            self.step()
+
+    def scenario(self, name, paths, load=None):
+        load = load or self.load
+        self.settle()
+        load.reset()
+        self.allocs = 0
+        nisy = len(self.isy.log)
+
+        if _MPY:
+            gc.collect()
+            gc.disable()
+        t0 = time.ticks_us()
+        for p in paths:
+            load.add(p)
+        while load.pending():
+            self.step()
+        t1 = time.ticks_us()
+        while not self.drained():
+            self.step()
+        t2 = time.ticks_us()
+        if _MPY:
+            gc.enable()
+
+        n = len(paths)
+        lat = sorted(load.latency)
+        us = max(1, time.ticks_diff(t1, t0))
+        print("%-12s %5d %8d %8.1f %8.2f %8.2f %9.1f %8.2f %5d %4d %4d" %
+              (name, n, us // 1000, n * 1000000 / us,
+               _pct(lat, 50) / 1000, _pct(lat, 99) / 1000,
+               self.allocs / n, time.ticks_diff(t2, t1) / 1000,
+               len(self.isy.log) - nisy, load.statuses.get(503, 0),
+               load.errors))
+
+# = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = #
+
+def _queries(n):
+    return [b"/uns/nodes/%s/query?requestId=%d" % (ADDR, i) for i in range(n)]
+
+def _commands(n):
+    cmds = (b"DON/50/51", b"C1", b"C2", b"DOF", b"C3", b"C4")
+    return [b"/uns/nodes/%s/cmd/%s?requestId=%d" % (ADDR, cmds[i % 6], i)
+            for i in range(n)]
+
+def _mixed(n):
+    p = []
+    for i in range(n // 5):
+        p.append(b"/uns/nodes/%s/status" % ADDR)
+        p += _commands(4)
+    return p
+
+def main():
+    b = Bench(slots=int(sys.argv[1]) if len(sys.argv) > 1 else 1)
+    print("%-12s %5s %8s %8s %8s %8s %9s %8s %5s %4s %4s" %
+          ("scenario", "reqs", "ms", "req/s", "p50_ms", "p99_ms",
+           "alloc/req", "drain_ms", "isy", "503", "err"))
+    try:
+        b.scenario("query", _queries(50))
+        b.scenario("command", _commands(100))
+        b.scenario("mixed", _mixed(100))
+        b.scenario("pipelined", _commands(100), b.pipe)
+        b.scenario("not_found", [b"/uns/nowhere"] * 50)
+
+        # A slow ISY: the restq backs up and the server pushes back
+        b.isy.delay_ms = 20
+        b.scenario("slow_query", [b"/uns/nodes/%s/query" % ADDR])
+        b.scenario("slow_isy", _commands(200))
+    finally:
+        b.close()
+
+main()
+
+# = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = #
@@ -0,0 +1,278 @@
+# test_http.py - framing tests for the server and client HTTP parsers
+#
+# Drives StateMachineServer and StateMachineClient over loopback sockets,
+# with the MicroPython modules the host lacks taken from bench/shim:
+#
+#   python3 -m unittest discover tests
+#
+# Each test feeds bytes split the awkward ways the ISY (or a client) can
+# produce them and checks what was framed: responses, ioq entries, and
+# whether the connection was kept.
+
+import socket
+import sys
+import unittest
+
+_here = __file__.rsplit("/", 1)[0] if "/" in __file__ else "."
+sys.path.insert(0, _here + "/..")
+sys.path.append(_here + "/../bench/shim")
+
+import install
+import utime as time
+from unslib import *
+
+PORT = 18500
+ISY_PORT = 18580
+
+def _pump(fn, until, ms=2000):
+    # Call fn() until until() is true; fail if it takes over ms
+    t = time.ticks_ms()
+    while not until():
+        if time.ticks_diff(time.ticks_ms(), t) > ms:
+            raise AssertionError("timed out")
+        fn()
+        time.sleep_ms(1)
+
+# = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = #
+
+class ServerTest(unittest.TestCase):
+
+    # A StateMachineServer with a small receive buffer, and a blocking
+    # client socket whose responses are collected while the server runs
+
+    def setUp(self):
+        self.ioq = RingQueue(16)
+        self.srv = StateMachineServer(self.ioq, PORT, maxconn=2, bufsize=256)
+        self.srv.run()
+        self.sock = socket.create_connection(("127.0.0.1", PORT))
+        self.sock.setblocking(False)
+        self.got = b""
+        self.eof = False
+
+    def tearDown(self):
+        self.sock.close()
+        self.srv._err()
+
+    def _step(self):
+        self.srv.run()
+        try:
+            d = self.sock.recv(4096)
+            if d:
+                self.got += d
+            else:
+                self.eof = True
+        except (BlockingIOError, ConnectionResetError):
+            pass
+
+    def _send(self, *parts):
+        # Send each part separately, letting the server run in between
+        for p in parts:
+            self.sock.sendall(p)
+            for i in range(5):
+                self._step()
+                time.sleep_ms(1)
+
+    def _responses(self, n):
+        _pump(self._step, lambda: self.got.count(b"HTTP/1.1 ") >= n)
+        return [r.split(b"\r\n", 1)[0] for r in self.got.split(b"HTTP/1.1 ")[1:]]
+
+    def _closed(self):
+        _pump(self._step, lambda: self.eof)
+
+    def _entries(self):
+        return [self.ioq[i] for i in range(len(self.ioq))]
+
+    def test_split_terminator_with_trailing_bytes(self):
+        # The blank line is split across reads, and the second read
+        # carries the start of the next request after it
+        self._send(b"GET /uns/nodes/n1/query HTTP/1.1\r\nHost: isy\r",
+                   b"\n\r\nGET /uns/nodes/n1/sta",
+                   b"tus HTTP/1.1\r\n\r\n")
+        self.assertEqual(self._responses(2), [b"200 OK", b"200 OK"])
+        self.assertEqual(self._entries(), [(IO_QUERY, b"n1"), (IO_STATUS, b"n1")])
+
+    def test_content_length_body(self):
+        # The body is skipped, even where it looks like a request, and
+        # may arrive after the header
+        self._send(b"POST /uns/nodes/n1/query HTTP/1.1\r\nContent-Length: 18\r\n\r\n",
+                   b"GET /uns/add/nodes",
+                   b"GET /uns/nodes/n1/status HTTP/1.1\r\n\r\n")
+        self.assertEqual(self._responses(2), [b"200 OK", b"200 OK"])
+        self.assertEqual(self._entries(), [(IO_QUERY, b"n1"), (IO_STATUS, b"n1")])
+
+    def test_pipelined(self):
+        # Several requests in one read are answered in order, on the
+        # same connection, with their request IDs
+        self._send(b"GET /uns/nodes/n1/cmd/DON?requestId=7 HTTP/1.1\r\n\r\n"
+                   b"GET /uns/nowhere HTTP/1.1\r\n\r\n"
+                   b"GET /uns/nodes/n1/cmd/DOF?requestId=8 HTTP/1.1\r\n\r\n")
+        self.assertEqual(self._responses(3), [b"200 OK", b"404 ERROR", b"200 OK"])
+        self.assertEqual(self._entries(), [(IO_CMD, b"n1", b"DON", None, None),
+                                           (IO_RID, b"7"),
+                                           (IO_CMD, b"n1", b"DOF", None, None),
+                                           (IO_RID, b"8")])
+        self.assertFalse(self.eof)
+
+    def test_connection_close(self):
+        self._send(b"GET /uns/nodes/n1/query HTTP/1.1\r\nConnection: close\r\n\r\n")
+        self.assertEqual(self._responses(1), [b"200 OK"])
+        self._closed()
+
+    def test_header_too_large(self):
+        self._send(b"GET /uns/nodes/n1/query HTTP/1.1\r\nX: " + b"a" * 300)
+        self.assertEqual(self._responses(1), [b"431 ERROR"])
+        self._closed()
+        self.assertEqual(self._entries(), [])
+
+    def test_body_too_large(self):
+        self._send(b"POST /uns/nodes/n1/query HTTP/1.1\r\nContent-Length: 500\r\n\r\n")
+        self.assertEqual(self._responses(1), [b"413 ERROR"])
+        self._closed()
+
+    def test_malformed(self):
+        self._send(b"GARBAGE\r\n\r\n")
+        self.assertEqual(self._responses(1), [b"400 ERROR"])
+        self._closed()
+
+    def test_bad_content_length(self):
+        self._send(b"POST /uns/nodes/n1/query HTTP/1.1\r\nContent-Length: x\r\n\r\n")
+        self.assertEqual(self._responses(1), [b"400 ERROR"])
+        self._closed()
+
+# = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = #
+
+class ClientTest(unittest.TestCase):
+
+    # A StateMachineClient sending to a scripted ISY on loopback, which
+    # answers each request with the next response, sent in the given
+    # pieces, and counts the connections it accepted
+
+    def setUp(self):
+        self.restq = ReportQueue()
+        self.client = StateMachineClient(self.restq, b"127.0.0.1",
+                                         b"127.0.0.1", ISY_PORT, b"eA==",
+                                         keepalive=True, retries=1)
+        self.lsock = socket.socket()
+        self.lsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.lsock.bind(("127.0.0.1", ISY_PORT))
+        self.lsock.listen(2)
+        self.lsock.setblocking(False)
+        self.conns = []
+        self.requests = []
+        self.script = []
+
+    def tearDown(self):
+        for s in self.conns:
+            s.close()
+        self.lsock.close()
+        for c in self.client._slots:
+            if c.sock is not None:
+                c.sock.close()
+
+    def _isy(self):
+        try:
+            s, a = self.lsock.accept()
+            s.setblocking(False)
+            self.conns.append(s)
+        except BlockingIOError:
+            pass
+        for s in self.conns:
+            try:
+                d = s.recv(4096)
+            except BlockingIOError:
+                continue
+            if d.endswith(b"\r\n\r\n"):
+                self.requests.append(d.split(b" ")[1])
+                for p in self.script.pop(0):
+                    s.sendall(p)
+                    for i in range(3):
+                        self.client.run()
+                        time.sleep_ms(1)
+
+    def _step(self):
+        self.client.run()
+        self._isy()
+
+    def _send(self, *responses):
+        # Queue one report per response, and run until all are answered
+        self.script = list(responses)
+        for i in range(len(responses)):
+            self.restq.ack(b"%d" % i, True)
+        _pump(self._step, lambda: not self.script and self.client.idle())
+
+    def test_content_length(self):
+        self._send((b"HTTP/1.1 200 OK\r\nContent-Le", b"ngth: 5\r\n\r\nab", b"cde"),
+                   (b"HTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\n",))
+        self.assertEqual(self.requests, [b"/rest/ns/3/report/request/0/success",
+                                         b"/rest/ns/3/report/request/1/success"])
+        self.assertEqual(len(self.conns), 1)
+
+    def test_chunked_with_extensions_and_trailers(self):
+        # Chunk sizes in hex with extensions, the body and the last
+        # chunk split across reads, then trailers; the connection is
+        # kept for the next request only if the framing was understood
+        self._send((b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n",
+                    b"a;name=value\r\n0123456789\r\n1",
+                    b"2\r\n0123456789abcdef01\r\n0;last\r\n",
+                    b"X-Trailer: 1\r\nY", b"-Trailer: 2\r\n\r\n"),
+                   (b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n0\r\n\r\n",))
+        self.assertEqual(len(self.requests), 2)
+        self.assertEqual(len(self.conns), 1)
+        self.assertIsNotNone(self.client._slots[0].sock)
+
+    def test_close_delimited(self):
+        # Without framing headers, the response ends when the ISY closes
+        # the socket, and the next request opens a new connection
+        self.script = [(b"HTTP/1.1 200 OK\r\n\r\nbody",),
+                       (b"HTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\n",)]
+        self.restq.ack(b"0", True)
+        _pump(self._step, lambda: len(self.script) == 1)
+        self.conns.pop(0).close()
+        self.restq.ack(b"1", True)
+        _pump(self._step, lambda: not self.script and self.client.idle())
+        self.assertEqual(len(self.requests), 2)
+        self.assertEqual(len(self.conns), 1)
+
+    def test_error_status_retried(self):
+        # A 503 (the ISY busy) or a status line we cannot parse fails
+        # the request, which is sent again on a new connection
+        self.client._backoff = 1
+        self.client._retries = 3
+        self.script = [(b"HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\n\r\n",),
+                       (b"HTTP/1.1 abc\r\nContent-Length: 0\r\n\r\n",),
+                       (b"HTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\n",)]
+        self.restq.ack(b"0", True)
+        _pump(self._step, lambda: not self.script and self.client.idle())
+        self.assertEqual(self.requests, [b"/rest/ns/3/report/request/0/success"] * 3)
+        self.assertEqual(len(self.conns), 3)
+
+    def test_error_status_dropped(self):
+        # After retries failed attempts the request is dropped, and the
+        # next one is sent
+        self.client._backoff = 1
+        self.client._retries = 2
+        self.script = [(b"HTTP/1.1 500 Internal Server Error\r\nContent-Length: 0\r\n\r\n",),
+                       (b"HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\n\r\n",),
+                       (b"HTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\n",)]
+        self.restq.ack(b"0", True)
+        self.restq.ack(b"1", True)
+        _pump(self._step, lambda: not self.script and self.client.idle())
+        self.assertEqual(self.requests, [b"/rest/ns/3/report/request/0/success",
+                                         b"/rest/ns/3/report/request/0/success",
+                                         b"/rest/ns/3/report/request/1/success"])
+        self.assertEqual(len(self.restq), 0)
+
+    def test_unreachable_counted_per_round(self):
+        # Both slots fail to connect in each round, which counts once
+        # towards opening the circuit
+        client = StateMachineClient(self.restq, b"127.0.0.1", b"127.0.0.1",
+                                    ISY_PORT + 1, b"eA==", slots=2,
+                                    retries=3, backoff=20)
+        self.restq.report(b"n1", b"ST", 1, 17)
+        self.restq.report(b"n1", b"GV1", 2, 17)
+        _pump(client.run, lambda: client._fails >= 3)
+        self.assertEqual(client._fails, 3)
+        self.assertEqual(len(client._busy), 2)
+
+if __name__ == "__main__":
+    unittest.main()
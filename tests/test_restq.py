@@ -0,0 +1,76 @@
+# test_restq.py - ordering tests for ReportQueue with a SpillQueue
+#
+#   python3 -m unittest discover tests
+#
+# Each test queues entries past the high watermark, so some are spilled
+# to a file, and checks the order the client is handed them in.
+
+import sys
+import tempfile
+import unittest
+
+_here = __file__.rsplit("/", 1)[0] if "/" in __file__ else "."
+sys.path.insert(0, _here + "/..")
+sys.path.append(_here + "/../bench/shim")
+
+import install
+from unslib import *
+from unssched import Budget
+
+# = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = #
+
+class SpillOrderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.restq = ReportQueue(spill=SpillQueue(self.dir.name + "/restq.spl", 4096),
+                                 high=2)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def _drain(self):
+        # The request IDs of the acks, in the order they are taken
+        b = bytearray(1024)
+        rids = []
+        while True:
+            r = self.restq.take((), b, 0)
+            if r is None:
+                return rids
+            rids.append(bytes(b[0:r[0]]).split(b"/")[6])
+
+    def test_spilled_in_order(self):
+        for i in range(6):
+            self.restq.ack(b"%d" % i, True)
+        self.assertEqual(self.restq.ram_len(), 2)
+        self.assertEqual(self._drain(), [b"%d" % i for i in range(6)])
+
+    def test_too_long_to_spill(self):
+        # An entry too long for a spill record waits behind the spilled
+        # entries, and so does everything queued after it
+        for i in range(4):
+            self.restq.ack(b"%d" % i, True)
+        self.restq.ack(b"x" * 300, True)
+        self.restq.ack(b"4", True)
+        self.assertEqual(len(self.restq), 6)
+        self.assertEqual(self._drain(), [b"0", b"1", b"2", b"3", b"x" * 300, b"4"])
+
+    def test_overloaded_when_spill_fills(self):
+        # The server pushes back before the spill starts dropping the
+        # oldest records, and until it has drained to half the watermark
+        budget = Budget(RingQueue(4), self.restq, restq_high=24, spill_high=75)
+        n = 0
+        while self.restq.spill_used() <= 75:
+            self.assertFalse(budget.overloaded())
+            self.restq.ack(b"r" * 100, True)
+            n += 1
+        self.assertTrue(budget.overloaded())
+        self.assertEqual(len(self.restq), n)
+        b = bytearray(1024)
+        while self.restq.spill_used() > 37:
+            self.assertTrue(budget.overloaded())
+            self.restq.take((), b, 0)
+        self.assertFalse(budget.overloaded())
+
+if __name__ == "__main__":
+    unittest.main()
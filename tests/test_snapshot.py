@@ -0,0 +1,119 @@
+# test_snapshot.py - tests for saving and restoring the node driver values
+#
+# Runs NodeRegistry and Snapshot on the host, with the MicroPython
+# modules it lacks taken from bench/shim:
+#
+#   python3 -m unittest discover tests
+#
+# Each test writes a snapshot, restores it into a fresh registry, as a
+# restart would, and checks which drivers are reported again.
+
+import os
+import sys
+import tempfile
+import unittest
+
+_here = __file__.rsplit("/", 1)[0] if "/" in __file__ else "."
+sys.path.insert(0, _here + "/..")
+sys.path.append(_here + "/../bench/shim")
+
+import install
+import utime as time
+from unslib import *
+from unsnode import *
+from unssched import Scheduler
+
+DRIVERS = ((b"ST", 17), (b"CLIHUM", 22))
+
+def _pump(fn, until, ms=2000):
+    # Call fn() until until() is true; fail if it takes over ms
+    t = time.ticks_ms()
+    while not until():
+        if time.ticks_diff(time.ticks_ms(), t) > ms:
+            raise AssertionError("timed out")
+        fn()
+        time.sleep_ms(1)
+
+# = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = #
+
+class SnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = self.dir.name + "/state.bin"
+        self.sched = Scheduler()
+        self.restq, self.node, self.snap = self._boot()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def _boot(self):
+        # A registry with one node, restored from the snapshot if any
+        restq = ReportQueue()
+        nodes = NodeRegistry(RingQueue(4), restq)
+        node = nodes.add(Node(b"n003_th", b"TH", b"Temp", DRIVERS))
+        snap = Snapshot(nodes, self.path, self.sched, delay=20)
+        snap.restore()
+        return restq, node, snap
+
+    def _reported(self, restq, node):
+        # The driver ids queued for node after a startup report
+        node._nodes.report_all()
+        return sorted(k[2] for k in restq._pending if k[1] == node._addr)
+
+    def test_saved_after_report(self):
+        # A report queues a save delay ms later; none is written before
+        self.node.set(0, 215)
+        self.node.set(1, 40)
+        self.assertFalse(os.path.exists(self.path))
+        _pump(self.sched.run, lambda: os.path.exists(self.path))
+        self.assertFalse(self.node._nodes._changed)
+        restq, node, snap = self._boot()
+        self.assertEqual(list(node._value), [215, 40])
+        self.assertEqual(self._reported(restq, node), [])
+
+    def test_burst_is_one_save(self):
+        self.node.set(0, 215)
+        _pump(self.sched.run, lambda: os.path.exists(self.path))
+        t = os.stat(self.path).st_mtime_ns
+        for v in range(216, 226):
+            self.node.set(0, v)
+        self.assertEqual(len(self.sched._tasks), 1)
+        _pump(self.sched.run, lambda: not self.sched._tasks)
+        self.assertNotEqual(os.stat(self.path).st_mtime_ns, t)
+        restq, node, snap = self._boot()
+        self.assertEqual(node.get(0), 225)
+
+    def test_stale_snapshot(self):
+        # The device restarts after a report was sent but before it was
+        # saved: the restored values are the older ones, and a reading
+        # that differs from them is reported, so the ISY catches up
+        self.node.set(0, 215)
+        self.node.set(1, 40)
+        self.snap.save()
+        self.node.set(0, 230)
+        restq, node, snap = self._boot()
+        self.assertEqual(list(node._sent), [215, 40])
+        node.set(0, 230)
+        self.assertEqual(self._reported(restq, node), [b"ST"])
+
+    def test_unsent_restored_as_dirty(self):
+        # Drivers never sent before the save are reported after restore
+        self.node.set(0, 215, report=False)
+        self.snap.save()
+        restq, node, snap = self._boot()
+        self.assertEqual(self._reported(restq, node), [b"CLIHUM", b"ST"])
+
+    def test_layout_changed(self):
+        # A node whose drivers no longer match the file is not restored
+        self.node.set(0, 215)
+        self.snap.save()
+        restq = ReportQueue()
+        nodes = NodeRegistry(RingQueue(4), restq)
+        node = nodes.add(Node(b"n003_th", b"TH", b"Temp",
+                              ((b"CLIHUM", 22), (b"ST", 17))))
+        self.assertEqual(Snapshot(nodes, self.path, self.sched).restore(), 0)
+        self.assertEqual(list(node._value), [0, 0])
+
+if __name__ == "__main__":
+    unittest.main()
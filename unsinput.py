@@ -0,0 +1,145 @@
+# unsinput.py
+#
+# = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = #
+#
+# MIT License
+#
+# Copyright (c) 2017 Mike Westerhof
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = #
+
+import machine
+import micropython
+import uarray as array
+import utime as time
+
+micropython.alloc_emergency_exception_buf(100)
+
+# = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = #
+
+class Inputs():
+
+    # Digital inputs serviced by pin interrupts instead of polling.  The
+    # interrupt handler only debounces the edge and records it, with its
+    # time, in a ring buffer allocated up front; run() drains the ring
+    # from the main loop and calls each input's handler(value, ticks).
+    #
+    # An edge within debounce ms of the last one accepted on the same
+    # input is taken as contact bounce and ignored.  Since a bounce can
+    # end in either state, run() re-reads such an input once its window
+    # has passed and records the level it settled at if that differs,
+    # setting a timer so the loop wakes up to do so.
+    # When the ring is full, new edges are counted as dropped.
+
+    _sched = None
+    _debounce = 20
+
+    _pins = None
+    _handlers = None
+    _level = None       # last recorded level of each input
+    _last = None        # ticks_ms of the last accepted edge of each input
+    _settle = None      # 1 if an input ignored a bounce since its last edge
+
+    _ev_input = None    # the ring: input index, level and ticks_ms
+    _ev_level = None
+    _ev_ticks = None
+    _head = 0           # next slot the interrupt handler writes
+    _tail = 0           # next slot run() reads
+    _recheck = False    # a timer is set to look at settling inputs
+
+    dropped = 0
+
+    _debug = 0
+
+    def __init__(self, sched, size=16, debounce=20, latency=10, debug=0):
+        self._sched = sched
+        self._debounce = debounce
+        self._pins = []
+        self._handlers = []
+        self._level = bytearray(0)
+        self._last = array.array("l")
+        self._settle = bytearray(0)
+        self._ev_input = bytearray(size)
+        self._ev_level = bytearray(size)
+        self._ev_ticks = array.array("l", [0] * size)
+        self._debug = debug
+        sched.set_latency(latency)
+
+    def add(self, pin, handler, trigger=machine.Pin.IRQ_FALLING | machine.Pin.IRQ_RISING):
+        # Watch pin (already configured as an input); handler is called
+        # from run() with the new level and the ticks_ms of the edge.
+        i = len(self._pins)
+        self._pins.append(pin)
+        self._handlers.append(handler)
+        self._level.append(pin.value())
+        self._last.append(time.ticks_add(time.ticks_ms(), -self._debounce))
+        self._settle.append(0)
+        pin.irq(handler=lambda p: self._irq(i, p.value()), trigger=trigger)
+        return i
+
+    def run(self):
+        # Deliver queued edges.  Returns have_work.
+        have_work = False
+        while self._tail != self._head:
+            t = self._tail
+            i = self._ev_input[t]
+            self._handlers[i](self._ev_level[t], self._ev_ticks[t])
+            self._tail = (t + 1) % len(self._ev_input)
+            have_work = True
+        settling = False
+        for i in range(len(self._pins)):
+            if self._settle[i]:
+                st = machine.disable_irq()
+                self._irq(i, self._pins[i].value())
+                machine.enable_irq(st)
+                settling = settling or self._settle[i]
+        if settling and not self._recheck:
+            self._recheck = True
+            self._sched.after(self._debounce, self._rechecked)
+        return have_work
+
+    def _rechecked(self):
+        self._recheck = False
+
+    def _irq(self, i, v):
+        # Interrupt context: no allocation, no printing
+        now = time.ticks_ms()
+        if v == self._level[i]:
+            self._settle[i] = 0
+            return
+        if time.ticks_diff(now, self._last[i]) < self._debounce:
+            self._settle[i] = 1
+            return
+        self._settle[i] = 0
+        self._level[i] = v
+        self._last[i] = now
+        h = self._head
+        n = (h + 1) % len(self._ev_input)
+        if n == self._tail:
+            self.dropped += 1
+            return
+        self._ev_input[h] = i
+        self._ev_level[h] = v
+        self._ev_ticks[h] = now
+        self._head = n
+        self._sched.wake()
+
+# = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = #
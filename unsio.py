@@ -0,0 +1,207 @@
+# unsio.py
+#
+# = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = #
+#
+# MIT License
+#
+# Copyright (c) 2017 Mike Westerhof
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = #
+
+import dht
+import machine
+import utime as time
+from unsnode import *
+from unsprofile import *
+from unsinput import *
+from unssensor import *
+from unstrace import *
+
+# = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = #
+
+class DHTSensor(Sensor):
+
+    # DHT11 temperature (C) and humidity (%).  measure() bit-bangs the
+    # whole exchange, so there is no start()/read() split to exploit.
+
+    name = "dht"
+    period = 10103      # stagger +103ms from the other 10s work
+    stale = 30000
+
+    _dht = None
+
+    def __init__(self, pin):
+        self._dht = dht.DHT11(pin)
+
+    def read(self):
+        try:
+            self._dht.measure()
+        except OSError:
+            return None
+        return (self._dht.temperature(), self._dht.humidity())
+
+# = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = #
+
+class MainNode(Node):
+
+    # The ESP_MAIN node: LED1 (PWM dimmed, ST), LED2 (on/off, GV1) and
+    # a DHT11 temperature/humidity sensor (GV6/GV7).  Its drivers and
+    # the commands it accepts come from the profile, via unsprofile.
+
+    # Reporting policies for the DHT11 readings: it only resolves whole
+    # degrees and percent, and flickers between neighbouring values
+    _temp_policy = Policy(deadband=1, min_ms=30000, max_ms=600000,
+                          window=3, median=True)
+    _hum_policy = Policy(deadband=2, min_ms=30000, max_ms=600000,
+                         window=5)
+
+    # Every command only sets LED drivers, so runs of them can be folded
+    _coalesce = (b"C1", b"C2", b"C3", b"C4", b"DON", b"DOF")
+
+    _led1 = None
+    _led2 = None
+    _dht = None
+    _sensors = None
+
+    def __init__(self, addr, name, sensors):
+        super().__init__(addr, ESP_MAIN, name, ESP_MAIN_DRIVERS)
+        self._led1 = machine.PWM(machine.Pin(15), freq=1000)
+        self._led1.duty(0)
+        self._led2 = machine.Pin(2, machine.Pin.OUT)
+        self._led2.value(0)
+        self.policy(ESP_MAIN_GV6, self._temp_policy)
+        self.policy(ESP_MAIN_GV7, self._hum_policy)
+        self._sensors = sensors
+        self._dht = sensors.add(DHTSensor(machine.Pin(4)), self._dht_sample)
+
+    def update(self):
+        # Set LED1 based on the command
+        self._led1.duty(int(self.get(ESP_MAIN_ST) * 10.23))
+
+        # Set LED2 based on the command
+        self._led2.value(self.get(ESP_MAIN_GV1))
+
+    def _dht_sample(self, v):
+        self.set(ESP_MAIN_GV6, int(((v[0]*9)/5)+32))
+        self.set(ESP_MAIN_GV7, v[1])
+
+    def query(self):
+        # Answer from the cached reading; if that is stale, sample again
+        # as soon as the loop is idle and report the result then
+        if not self._dht.fresh():
+            self._sensors.refresh(self._dht)
+
+    def _cmd_c1(self, value, uom):
+        if self.get(ESP_MAIN_ST) < 100:
+            self.set(ESP_MAIN_ST, self.get(ESP_MAIN_ST) + 1)
+
+    def _cmd_c2(self, value, uom):
+        if self.get(ESP_MAIN_ST) > 0:
+            self.set(ESP_MAIN_ST, self.get(ESP_MAIN_ST) - 1)
+
+    def _cmd_c3(self, value, uom):
+        self.set(ESP_MAIN_GV1, 1)
+
+    def _cmd_c4(self, value, uom):
+        self.set(ESP_MAIN_GV1, 0)
+
+    def _cmd_dof(self, value, uom):
+        self.set(ESP_MAIN_ST, 0)
+
+    def _cmd_don(self, value, uom):
+        if value is not None:
+            self.set(ESP_MAIN_ST, int(value))
+        else:
+            self.set(ESP_MAIN_ST, 100)
+
+# Bind the commands the profile says ESP_MAIN accepts to their handlers
+commands(MainNode, ESP_MAIN_ACCEPTS)
+
+# = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = #
+
+class HandleIO():
+
+    _nodes = None
+    _main = None
+    _inputs = None
+    _snapshot = None
+
+    _trace = NOTRACE
+    _debug = 0
+
+    def __init__(self, ioq, restq, sched, sensors, state=None, trace=None,
+                 debug=0):
+        if trace is not None:
+            self._trace = trace
+        self._debug = debug
+        self._nodes = NodeRegistry(ioq, restq, trace=trace)
+        self._main = self._nodes.add(MainNode(b"n003_esp", b"esp8266", sensors))
+
+        # Warm restart: pick up the driver values saved before a reset,
+        # so the startup report only covers what has changed since
+        if state is not None:
+            self._snapshot = Snapshot(self._nodes, state, sched, trace=trace)
+            if self._snapshot.restore():
+                self._main.update()
+
+        # Digital inputs raise interrupts; declare more with add()
+        self._inputs = Inputs(sched, debug=debug)
+        self._inputs.add(machine.Pin(12, machine.Pin.IN, machine.Pin.PULL_UP),
+                         self._button)
+
+        # Update the ISY on startup, then run the timed work on its own
+        # schedule.  Sensors are sampled by the Sensors object.
+        sched.after(0, self._nodes.report_all)
+        sched.every(1000, self._nodes.report_due)
+        sched.every((60000*9)-333, self._heartbeat)
+        
+    def run(self, limit=0):
+        # Handle input events, then input queue entries for up to limit
+        # us (just one if limit is 0); timed work is run by the scheduler
+        have_work = self._inputs.run()
+        start = time.ticks_us()
+        changed = False
+        while self._nodes.run():
+            changed = True
+            if limit <= 0 or time.ticks_diff(time.ticks_us(), start) > limit:
+                break
+        if changed:
+            self._main.update()
+            have_work = True
+        return have_work
+
+    def save(self):
+        # Write the driver values out now, e.g. before a planned restart
+        if self._snapshot is not None:
+            self._snapshot.save()
+
+    def _button(self, value, ticks):
+        # Report every press straight away
+        if value == 0:
+            if self._trace.on:
+                self._trace.log(T_IO, E_BUTTON)
+            self._main.send_cmd(b"CA")
+
+    def _heartbeat(self):
+        # Handle 9m Heartbeat polling here... (stagger -333 ms)
+        self._main.send_cmd(b"CB")
+
+# = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = #
@@ -26,42 +26,679 @@
 #
 # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = #
 
+import urandom as random
+import uselect as select
 import usocket as socket
 import utime as time
+from unstrace import *
 
 # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = #
 
+# Receive directly into a preallocated buffer.  CPython sockets provide
+# recv_into(); MicroPython's provide readinto(), which returns None
+# instead of raising EAGAIN when a non-blocking socket has no data.
+try:
+    _recv_into = socket.socket.recv_into
+except AttributeError:
+    _recv_into = socket.socket.readinto
+
+# Small helpers for parsing HTTP in place in a bytearray, so that no
+# intermediate byte strings are created on the request path.
+
+def _find(b, ch, i, n):
+    # Index of byte value ch in b[i:n], or -1.
+    while i < n:
+        if b[i] == ch:
+            return i
+        i += 1
+    return -1
+
+def _eoh(b, i, n):
+    # Offset just past the first blank line (CRLF CRLF) in b[0:n], where
+    # b[0:i] has already been scanned without finding one.
+    i = i - 3 if i > 3 else 0
+    while i + 3 < n:
+        if b[i+3] == 10 and b[i+2] == 13 and b[i+1] == 10 and b[i] == 13:
+            return i + 4
+        i += 1
+    return -1
+
+def _match(b, i, n, lit):
+    # Does b[i:n] start with lit, ignoring case?  lit must be lower case.
+    if n - i < len(lit):
+        return False
+    for ch in lit:
+        c = b[i]
+        if 65 <= c <= 90:
+            c |= 32
+        if c != ch:
+            return False
+        i += 1
+    return True
+
+def _equal(b, i, n, lit):
+    # Is b[i:n] exactly lit?
+    if n - i != len(lit):
+        return False
+    for ch in lit:
+        if b[i] != ch:
+            return False
+        i += 1
+    return True
+
+def _contains(b, i, n, lit):
+    # Does b[i:n] contain lit, ignoring case?  lit must be lower case.
+    n2 = n - len(lit)
+    while i <= n2:
+        if _match(b, i, n, lit):
+            return True
+        i += 1
+    return False
+
+def _int(b, i, n):
+    # Parse a decimal integer from b[i:n], skipping leading blanks.
+    # Returns -1 if there are no digits.
+    while i < n and b[i] == 32:
+        i += 1
+    v = -1
+    while i < n and 48 <= b[i] <= 57:
+        v = (0 if v < 0 else v * 10) + b[i] - 48
+        i += 1
+    return v
+
+# And for rendering requests straight into a preallocated buffer.  Each
+# returns the offset after what it wrote, or -1 if it did not fit; they
+# pass -1 through, so a request can be written as one chain of calls.
+
+def _put(b, i, p):
+    # Copy the bytes p into b at i
+    n = i + len(p)
+    if i < 0 or n > len(b):
+        return -1
+    b[i:n] = p
+    return n
+
+def _putint(b, i, v):
+    # Write the integer v in decimal into b at i
+    if i < 0:
+        return -1
+    if v < 0:
+        i = _put(b, i, b"-")
+        v = -v
+    n = 1
+    t = v
+    while t >= 10:
+        t //= 10
+        n += 1
+    if i < 0 or i + n > len(b):
+        return -1
+    k = i + n
+    while True:
+        k -= 1
+        b[k] = 48 + v % 10
+        v //= 10
+        if k == i:
+            return i + n
+
+
+# Operations placed on the ioq by StateMachineServer.  Each ioq entry is
+# a tuple whose first element is one of these:
+#   (IO_ADD,)                           /uns/add/nodes
+#   (IO_INSTALL, profile)               /uns/install/<profile>
+#   (IO_QUERY, addr)                    /uns/nodes/<addr>/query
+#   (IO_STATUS, addr)                   /uns/nodes/<addr>/status
+#   (IO_CMD, addr, cmd, value, uom)     /uns/nodes/<addr>/cmd/<cmd>[/<value>[/<uom>]]
+#   (IO_REPORT, addr, action, arg)      /uns/nodes/<addr>/report/<action>[/<arg>]
+#   (IO_RID, rid)                       requestId=<rid> on any of the above
+# Missing optional fields are None; all others are bytes.  IO_STATS and
+# IO_TRACE are answered by the server itself (/uns/stats and
+# /uns/trace[/<action>]) and never queued.
+
+IO_ADD = 65         # b"A"
+IO_CMD = 67         # b"C"
+IO_REPORT = 69      # b"E"
+IO_INSTALL = 73     # b"I"
+IO_QUERY = 81       # b"Q"
+IO_RID = 82         # b"R"
+IO_STATUS = 83      # b"S"
+IO_STATS = 84       # b"T"
+IO_TRACE = 88       # b"X"
+
+# = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = #
+
+class RingQueue():
+
+    # A FIFO held in a list allocated up front and used as a ring, so
+    # that append() and pop() of the oldest entry take constant time
+    # and allocate nothing.  The first entries can also be read with
+    # q[i] and removed with pop(i), which moves the i entries ahead of
+    # it; ReportQueue looks a few entries ahead this way.  If the ring
+    # fills it doubles in size rather than lose an entry, but the
+    # Budget watermarks should keep that from happening.  Used for the
+    # ioq, and by ReportQueue for the restq.
+
+    _slots = None
+    _head = 0           # index of the oldest entry
+    _count = 0
+
+    def __init__(self, size=64):
+        self._slots = [None] * size
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, i):
+        if i < 0 or i >= self._count:
+            raise IndexError(i)
+        return self._slots[(self._head + i) % len(self._slots)]
+
+    def append(self, x):
+        if self._count == len(self._slots):
+            self._grow()
+        self._slots[(self._head + self._count) % len(self._slots)] = x
+        self._count += 1
+
+    def pop(self, i=0):
+        if i < 0 or i >= self._count:
+            raise IndexError(i)
+        s = self._slots
+        n = len(s)
+        k = (self._head + i) % n
+        x = s[k]
+        while k != self._head:
+            j = k - 1 if k > 0 else n - 1
+            s[k] = s[j]
+            k = j
+        s[k] = None
+        self._head = (self._head + 1) % n
+        self._count -= 1
+        return x
+
+    def _grow(self):
+        s = self._slots
+        n = len(s)
+        self._slots = [s[(self._head + i) % n] for i in range(n)] + [None] * n
+        self._head = 0
+
+# = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = #
+
+# Entries on the restq.  Each is a tuple of an opcode and references to
+# byte strings the nodes already hold, rendered into a URL under the
+# queue's base only when the client sends it:
+#   (RQ_STATUS, node, driver)                   <base>/nodes/<node>/report/status/<driver>/<value>/<uom>
+#   (RQ_ACK, rid, outcome)                      <base>/report/request/<rid>/<outcome>
+#   (RQ_CMD, node, cmd)                         <base>/nodes/<node>/report/cmd/<cmd>
+#   (RQ_ADD, node, nodedef, primary, name)      <base>/nodes/<node>/add/<nodedef>?primary=<primary>&name=<name>
+#   (RQ_PATH, path)                             <path>, as given
+# A status entry is also the key of its pending value, which is only
+# filled in when it is rendered.
+
+RQ_STATUS = 1
+RQ_ACK = 2
+RQ_CMD = 3
+RQ_ADD = 4
+RQ_PATH = 5
+
+# Ordering keys for entries other than status reports; see ReportQueue.take
+_ORDERED = b"ordered"
+_BARRIER = b"barrier"
+_KORDERED = (_ORDERED,)
+_KBARRIER = (_BARRIER,)
+
+class ReportQueue():
+
+    # Outbound queue feeding StateMachineClient (restq).  Entries added
+    # with ack(), command(), add() and append() are sent exactly once
+    # and in order.  Driver status is added with report(); if a report
+    # for the same node and driver is still waiting, its value is
+    # replaced in place rather than a new entry queued.  A quickly
+    # changing driver therefore costs one queue slot, and only its
+    # latest value is sent, while still going out ahead of anything
+    # that was queued after it was first reported.
+    #
+    # Entries are the small tuples described above, held in a
+    # RingQueue, and take() renders them straight into the client's
+    # transmit buffer.  Status is sent in the per-driver form.
+    #
+    # Experimental: with batch > 1, a run of consecutive status entries
+    # for the same node (up to batch of them) is sent as one request,
+    #   <base>/nodes/<node>/report/status?<p1>.<uom1>=<val1>&...
+    # borrowing the <cps> parameters the URL notes give for report/cmd.
+    # The ISY is not documented to accept this form for status, so
+    # leave batch at 1 unless your ISY firmware has been checked to.
+    #
+    # Given a SpillQueue, ordered entries beyond the high watermark are
+    # written to it instead of being held in RAM, and read back, in
+    # order, as the queue drains.  Each spill record is the opcode
+    # followed by its fields, each preceded by its length.  Status
+    # entries always stay in RAM; there is at most one per driver, and
+    # they carry current state, so they may overtake spilled entries.
+    # An entry too long for a spill record, queued while entries are
+    # spilled, is held in RAM behind them, along with everything queued
+    # after it, until the spill has been read back.
+
+    _order = None       # RingQueue of entries
+    _held = None        # RingQueue of entries waiting for the spill to drain
+    _pending = None     # {status entry: (value, uom)}
+
+    _base = None
+    _batch = 1
+
+    _spill = None
+    _high = 0
+
+    def __init__(self, base=b"/rest/ns/3", batch=1, spill=None, high=32,
+                 size=64):
+        self._order = RingQueue(size)
+        self._held = RingQueue(4)
+        self._pending = {}
+        self._base = base
+        self._batch = batch
+        self._spill = spill
+        self._high = high
+
+    def __len__(self):
+        if self._spill is None:
+            return len(self._order)
+        return len(self._order) + len(self._spill) + len(self._held)
+
+    def ram_len(self):
+        # Entries held in RAM; spilled entries cost no memory
+        return len(self._order) + len(self._held)
+
+    def spill_used(self):
+        # Percentage of the SpillQueue in use (0 without one)
+        if self._spill is None:
+            return 0
+        return self._spill.used()
+
+    def report(self, node, driver, value, uom):
+        key = (RQ_STATUS, node, driver)
+        if key not in self._pending:
+            self._order.append(key)
+        self._pending[key] = (value, uom)
+
+    def ack(self, rid, ok):
+        self._queue((RQ_ACK, rid, b"success" if ok else b"failed"))
+
+    def command(self, node, cmd):
+        self._queue((RQ_CMD, node, cmd))
+
+    def add(self, node, nodedef, primary, name):
+        self._queue((RQ_ADD, node, nodedef, primary, name))
+
+    def append(self, p):
+        # Any other request, as a complete path
+        self._queue((RQ_PATH, p))
+
+    def _queue(self, x):
+        if self._spill is not None:
+            if len(self._held):
+                self._held.append(x)
+                return
+            if len(self._spill) or len(self._order) >= self._high:
+                p = self._pack(x)
+                if p is not None and self._spill.put(p):
+                    return
+                if len(self._spill):
+                    # Cannot be spilled, and must not overtake the spill
+                    self._held.append(x)
+                    return
+        self._order.append(x)
+
+    def take(self, busy, b, i, lookahead=16):
+        # For a client with several requests in flight: pop the first of
+        # the next lookahead entries that may be sent while requests with
+        # the keys in busy are outstanding, and render it into b at i.
+        # Returns (end, keys): the offset after the URL in b (-1 if it
+        # did not fit, and was dropped), and the keys to add to busy
+        # until the request completes.  None if nothing may be sent.
+        #   - Status reports are keyed by their entry, so there is never
+        #     more than one report for a driver in flight, and its last
+        #     value is the one the ISY is left with.
+        #   - Other entries share the key _ORDERED, so they go out one
+        #     at a time and in order; status reports may overtake them.
+        #   - Node adds are barriers (_BARRIER): one is only sent once
+        #     everything ahead of it has completed, and nothing behind
+        #     it is sent until it has.
+        if _BARRIER in busy:
+            return None
+        self._refill()
+        n = len(self._order)
+        if n > lookahead:
+            n = lookahead
+        ordered = _ORDERED not in busy
+        for k in range(n):
+            x = self._order[k]
+            if x[0] == RQ_STATUS:
+                if x not in busy:
+                    return self._take(k, busy, b, i)
+            elif x[0] == RQ_ADD:
+                if k == 0 and not busy:
+                    return self._take(k, busy, b, i)
+                return None
+            elif ordered:
+                return self._take(k, busy, b, i)
+        return None
+
+    def _refill(self):
+        if self._spill is not None and len(self._spill):
+            # Read spilled entries back once RAM has drained to half
+            if len(self._order) <= self._high // 2:
+                while len(self._spill) and len(self._order) < self._high:
+                    self._order.append(self._unpack(self._spill.get()))
+        if len(self._held) and not len(self._spill):
+            while len(self._held):
+                self._order.append(self._held.pop(0))
+
+    def _take(self, k, busy, b, i):
+        # Pop the entry at position k and render it into b at i; see take()
+        x = self._order.pop(k)
+        op = x[0]
+        base = self._base
+        if op == RQ_ACK:
+            i = _put(b, _put(b, _put(b, _put(b, i, base), b"/report/request/"), x[1]), b"/")
+            return _put(b, i, x[2]), _KORDERED
+        if op == RQ_CMD:
+            i = _put(b, _put(b, _put(b, i, base), b"/nodes/"), x[1])
+            return _put(b, _put(b, i, b"/report/cmd/"), x[2]), _KORDERED
+        if op == RQ_ADD:
+            i = _put(b, _put(b, _put(b, i, base), b"/nodes/"), x[1])
+            i = _put(b, _put(b, _put(b, i, b"/add/"), x[2]), b"?primary=")
+            return _put(b, _put(b, _put(b, i, x[3]), b"&name="), x[4]), _KBARRIER
+        if op == RQ_PATH:
+            return _put(b, i, x[1]), _KORDERED
+        node = x[1]
+        v = self._pending.pop(x)
+        i = _put(b, _put(b, _put(b, _put(b, i, base), b"/nodes/"), node), b"/report/status")
+        if self._batch < 2 or not self._batchable(k, node, busy):
+            i = _put(b, _put(b, _put(b, i, b"/"), x[2]), b"/")
+            return _putint(b, _put(b, _putint(b, i, v[0]), b"/"), v[1]), (x,)
+        keys = [x]
+        sep = b"?"
+        while True:
+            i = _put(b, _put(b, _put(b, i, sep), x[2]), b".")
+            i = _putint(b, _put(b, _putint(b, i, v[1]), b"="), v[0])
+            if len(keys) >= self._batch or not self._batchable(k, node, busy):
+                return i, keys
+            x = self._order.pop(k)
+            v = self._pending.pop(x)
+            keys.append(x)
+            sep = b"&"
+
+    def _batchable(self, k, node, busy):
+        # Is the entry at position k a status report for this node, and
+        # not for a driver with a report in flight?
+        if k >= len(self._order):
+            return False
+        x = self._order[k]
+        return (x[0] == RQ_STATUS and x[1] == node and
+                (busy is None or x not in busy))
+
+    def _pack(self, x):
+        # Spill record for an ordered entry: the opcode, then each field
+        # preceded by its length.  None if a field or the whole record
+        # is too long for a SpillQueue record, so the entry stays in RAM.
+        n = 1
+        for f in x[1:]:
+            n += 1 + len(f)
+        if n > 255:
+            return None
+        p = bytearray(1)
+        p[0] = x[0]
+        for f in x[1:]:
+            p.append(len(f))
+            p.extend(f)
+        return p
+
+    def _unpack(self, p):
+        x = [p[0]]
+        i = 1
+        while i < len(p):
+            n = p[i]
+            x.append(p[i + 1:i + 1 + n])
+            i += 1 + n
+        return tuple(x)
+
+# = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = #
+
+class SpillQueue():
+
+    # A fixed-size, file-backed FIFO of byte strings (at most 255 bytes
+    # each), used by ReportQueue to hold overflow during ISY outages
+    # without using up RAM.  The file is a ring: each record is a length
+    # byte followed by the data, written once at the tail, so flash
+    # writes are small and move steadily around the whole file.  When
+    # the ring is full, the oldest records are dropped to make room.
+    # The read and write positions are only kept in RAM, so spilled
+    # records do not survive a reboot.  They start at a random offset
+    # on each boot, so a device stuck in a reboot loop does not keep
+    # rewriting the start of the file.
+
+    _f = None
+    _size = 0
+    _head = 0           # file offset of the oldest record
+    _tail = 0           # file offset the next record is written at
+    _used = 0           # bytes of the file holding records
+    _count = 0          # records held
+    _len = None         # one-byte scratch buffer for record lengths
+
+    _trace = NOTRACE
+
+    def __init__(self, path, size=16384, trace=None):
+        self._size = size
+        if trace is not None:
+            self._trace = trace
+        self._len = bytearray(1)
+        try:
+            self._f = open(path, "r+b")
+            if self._f.seek(0, 2) != size:
+                self._f.close()
+                raise OSError(2)
+        except OSError:
+            # Create (or re-create) the file at its full size, so that it
+            # is never extended while in use
+            self._f = open(path, "w+b")
+            zero = bytes(256)
+            n = size
+            while n > 0:
+                self._f.write(zero if n >= 256 else zero[0:n])
+                n -= 256
+            self._f.flush()
+        self._head = self._tail = random.getrandbits(30) % size
+
+    def __len__(self):
+        return self._count
+
+    def used(self):
+        # Percentage of the file holding records
+        return self._used * 100 // self._size
+
+    def put(self, p):
+        n = len(p)
+        if n > 255 or n + 1 > self._size:
+            return False
+        if self._used + n + 1 > self._size:
+            if self._trace.on:
+                self._trace.log(T_SPILL, E_FULL, 0, self._count)
+            while self._used + n + 1 > self._size:
+                self._get(False)
+        self._len[0] = n
+        self._tail = self._write(self._tail, self._len)
+        self._tail = self._write(self._tail, p)
+        self._f.flush()
+        self._used += n + 1
+        self._count += 1
+        return True
+
+    def get(self):
+        if self._count == 0:
+            return None
+        return self._get(True)
+
+    def _get(self, keep):
+        self._head = self._readinto(self._head, self._len)
+        n = self._len[0]
+        p = None
+        if keep:
+            p = bytearray(n)
+            self._readinto(self._head, p)
+            p = bytes(p)
+        self._head = (self._head + n) % self._size
+        self._used -= n + 1
+        self._count -= 1
+        return p
+
+    def _write(self, pos, p):
+        # Write p at pos, wrapping at the end of the file; returns the
+        # position after it
+        k = self._size - pos
+        self._f.seek(pos)
+        if len(p) <= k:
+            self._f.write(p)
+        else:
+            self._f.write(p[0:k])
+            self._f.seek(0)
+            self._f.write(p[k:])
+        return (pos + len(p)) % self._size
+
+    def _readinto(self, pos, b):
+        # Fill b from pos, wrapping at the end of the file; returns the
+        # position after it
+        k = self._size - pos
+        self._f.seek(pos)
+        if len(b) <= k:
+            self._f.readinto(b)
+        else:
+            mv = memoryview(b)
+            self._f.readinto(mv[0:k])
+            self._f.seek(0)
+            self._f.readinto(mv[k:])
+        return (pos + len(b)) % self._size
+
+# = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = #
+
+class _ServerConn():
+
+    # Per-connection state record for StateMachineServer.  Each accepted
+    # client socket gets one of these, and carries its own state pointer
+    # and buffers so that several requests can be in progress at once.
+    # The records and their receive buffers are allocated once, when the
+    # server is created, and reused for every connection.
+
+    sock = None
+    next = None
+    wait = 0        # poll event mask this state is waiting on (0 = none)
+    ready = False   # set when poll reports the awaited event
+    since = 0       # ticks_ms of the last activity, for the idle timeout
+    ibuf = None     # receive buffer; a whole request must fit in it
+    imv = None      # memoryview of ibuf
+    ilen = 0        # bytes held in ibuf
+    iscan = 0       # bytes of ibuf already scanned for the end of header
+    hend = 0        # offset just past the header, 0 until it is found
+    blen = 0        # Content-Length of the request body
+    path = 0        # offsets of the request path (with query) in ibuf
+    pend = 0
+    close = False   # close the connection after this response
+    obuf = None     # memoryview of the response being sent
+    obufp = 0
+    ident = 0       # number of this record (from 1), for the trace
+
+    def __init__(self, size, ident):
+        self.ident = ident
+        self.ibuf = bytearray(size)
+        self.imv = memoryview(self.ibuf)
+
+# = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = #
+
+def _response(status, body, close):
+    # A complete canned response, framed by Content-Length so that the
+    # connection can be kept open for the next request.
+    return memoryview(b"HTTP/1.1 %s\r\nContent-Type: text/plain\r\nContent-Length: %d\r\n%s\r\n%s" %
+                      (status, len(body), b"Connection: close\r\n" if close else b"", body))
+
 class StateMachineServer():
 
     _next = None
 
     _sock = None
-    _client_sock = None
-    _ibuf = b""
-    _obuf = b""
+    _poll = None
+    _poller = None      # shared poll object (see unssched.Scheduler)
+    _conns = None
+    _free = None
+    _maxconn = 1
+    _accepting = False
 
     _ioq = None
 
-    _r200 = b"HTTP/1.0 200 OK\r\nContent-Type: text/plain\r\n\r\nOK\r\n"
-    _r404 = b"HTTP/1.0 404 ERROR\r\nContent-Type: text/plain\r\n\r\nERROR 404\r\n"
+    # Route table for inbound requests, matched segment by segment
+    # against the path in the receive buffer.  A None segment matches
+    # anything and is captured into the ioq entry; a route matches paths
+    # with at least nmin of its segments, missing captures being None.
+    #        segments                                       nmin  op
+    _routes = (((b"uns", b"add", b"nodes"),                    3, IO_ADD),
+               ((b"uns", b"install", None),                    3, IO_INSTALL),
+               ((b"uns", b"nodes", None, b"query"),            4, IO_QUERY),
+               ((b"uns", b"nodes", None, b"status"),           4, IO_STATUS),
+               ((b"uns", b"nodes", None, b"cmd",
+                 None, None, None),                            5, IO_CMD),
+               ((b"uns", b"nodes", None, b"report",
+                 None, None),                                  5, IO_REPORT),
+               ((b"uns", b"stats"),                            2, IO_STATS),
+               ((b"uns", b"trace", None),                      2, IO_TRACE))
+    _segs = None        # scratch: start/end offsets of each path segment
+
+    # Responses that may keep the connection open come in pairs, indexed
+    # by the connection's close flag.  Errors that leave the request
+    # framing in doubt always close.
+    _r200 = (_response(b"200 OK", b"OK\r\n", False),
+             _response(b"200 OK", b"OK\r\n", True))
+    _r404 = (_response(b"404 ERROR", b"ERROR 404\r\n", False),
+             _response(b"404 ERROR", b"ERROR 404\r\n", True))
+    _r503 = (_response(b"503 ERROR", b"ERROR 503\r\n", False),
+             _response(b"503 ERROR", b"ERROR 503\r\n", True))
+    _r400 = _response(b"400 ERROR", b"ERROR 400\r\n", True)
+    _r413 = _response(b"413 ERROR", b"ERROR 413\r\n", True)
+    _r431 = _response(b"431 ERROR", b"ERROR 431\r\n", True)
+
+    _rhdr = b"HTTP/1.1 200 OK\r\nContent-Type: %s\r\nContent-Length: %d\r\n%s\r\n"
 
     _port = None
+    _idle = 5000        # ms a connection may wait to read or write without progress
+    _overloaded = None  # function: True if requests should get a 503
 
-    _debug = 0
+    _stats = None
+    _trace = NOTRACE
 
-    def __init__(self, ioq, port, debug=0):
+    def __init__(self, ioq, port, maxconn=1, bufsize=1024, poller=None,
+                 idle=5000, overloaded=None, stats=None, trace=None):
         self._next = self._open
+        self._stats = stats
         self._ioq = ioq
         self._port = port
-        self._debug = debug
+        self._idle = idle
+        self._overloaded = overloaded
+        self._maxconn = maxconn
+        self._poller = poller
+        self._conns = []
+        self._free = [_ServerConn(bufsize, i + 1) for i in range(maxconn)]
+        self._segs = [0] * 16
+        if trace is not None:
+            self._trace = trace
         
     def run(self, limit=0):
         have_work = True
-        if limit > 0:
+        if limit > 0 or self._stats is not None:
             start = time.ticks_us()
         while (True):
             # Execute the next state in the state machine
-            have_work = self._next()
+            if self._stats is None:
+                have_work = self._next()
+            else:
+                f = self._next
+                t = time.ticks_us()
+                have_work = f()
+                self._stats.time("server", f.__name__, time.ticks_diff(time.ticks_us(), t))
             # No more work?  No limit? Then we're done.
             if (not have_work) or not (limit > 0):
                 break
@@ -70,21 +707,42 @@ class StateMachineServer():
             delta = time.ticks_diff(now, start)
             if delta > limit:
                 break
+        if self._stats is not None and limit > 0:
+            self._stats.slice("server", time.ticks_diff(time.ticks_us(), start), limit)
         return have_work
 
+    def listening(self):
+        return self._sock is not None
+
+    def active(self):
+        # Number of open connections
+        return len(self._conns)
+
     def _err(self):
         try:
             if self._sock is not None:
-                self._sock.close()
+                self._poll.unregister(self._sock)
         except:
             pass
         try:
-            if self._clientsock is not None:
-                self._clientsock.close()
+            if self._sock is not None:
+                self._sock.close()
         except:
             pass
-        self._ibuf = b""
-        self._obuf = b""
+        for c in self._conns:
+            try:
+                self._poll.unregister(c.sock)
+            except:
+                pass
+            try:
+                c.sock.close()
+            except:
+                pass
+            c.sock = None
+            self._free.append(c)
+        self._sock = None
+        self._poll = None
+        self._conns = []
         self._next = self._open
         return False
         
@@ -94,18 +752,93 @@ class StateMachineServer():
         self._sock.setblocking(False)
         self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self._sock.bind(addr)
-        self._sock.listen(1)
-        if self._debug > 0:
-            print("Server: Listening...")
-        self._next = self._accept
+        self._sock.listen(self._maxconn)
+        if self._poller is not None:
+            self._poll = self._poller
+        else:
+            self._poll = select.poll()
+        self._poll.register(self._sock, select.POLLIN)
+        self._accepting = True
+        if self._trace.on:
+            self._trace.log(T_SERVER, E_LISTEN, 0, self._port)
+        self._next = self._serve
         return True
 
+    def _serve(self):
+        # Collect readiness for the listening socket and every client
+        # connection in one poll, then advance each connection by one
+        # state.  Connections in a state that is not waiting on the
+        # socket (processing, closing) are always advanced.
+        have_work = False
+        accept = False
+        for ev in self._poll.poll(0):
+            s = ev[0]
+            if s is self._sock:
+                accept = True
+                continue
+            for c in self._conns:
+                if c.sock is s:
+                    c.ready = True
+                    break
+        if accept:
+            have_work = self._accept()
+        if self._conns:
+            now = time.ticks_ms()
+        for c in self._conns[:]:
+            # A kept-alive client that sends nothing more, or one that
+            # stalls mid-request or stops reading its response, would
+            # otherwise hold its slot for good
+            if (c.wait != 0 and not c.ready and
+                    time.ticks_diff(now, c.since) > self._idle):
+                if self._trace.on:
+                    self._trace.log(T_SERVER, E_IDLE, c.ident,
+                                    time.ticks_diff(now, c.since))
+                c.next = self._close
+                self._wait(c, 0)
+            if c.wait == 0 or c.ready:
+                if self._stats is None:
+                    if c.next(c):
+                        have_work = True
+                else:
+                    f = c.next
+                    t = time.ticks_us()
+                    if f(c):
+                        have_work = True
+                    self._stats.time("server", f.__name__, time.ticks_diff(time.ticks_us(), t))
+        return have_work
+
+    def _wait(self, c, event):
+        # Switch the poll mask for a connection to the event its next
+        # state needs.  Passing 0 means the next state needs no I/O.
+        if c.wait != event:
+            c.wait = event
+            self._poll.modify(c.sock, event)
+        c.ready = False
+
+    def _throttle(self):
+        # Stop polling the listening socket while at the connection cap,
+        # leaving further clients in the listen backlog until one closes.
+        accepting = len(self._conns) < self._maxconn
+        if accepting != self._accepting:
+            self._accepting = accepting
+            self._poll.modify(self._sock, select.POLLIN if accepting else 0)
+
     def _accept(self):
         have_work = False
         try:
-            self._clientsock, addr = self._sock.accept()
-            self._clientsock.setblocking(False)
-            self._next = self._read
+            s, addr = self._sock.accept()
+            s.setblocking(False)
+            c = self._free.pop()
+            c.sock = s
+            c.next = self._read
+            c.wait = select.POLLIN
+            c.ready = False
+            c.since = time.ticks_ms()
+            self._poll.register(c.sock, c.wait)
+            self._conns.append(c)
+            self._throttle()
+            if self._trace.on:
+                self._trace.log(T_SERVER, E_ACCEPT, c.ident, len(self._conns))
             have_work = True
         except OSError as e:
             if e.args[0] == 11:     # EAGAIN - operation would block
@@ -113,132 +846,373 @@ class StateMachineServer():
             elif e.args[0] == 110:  # ETIMEDOUT
                 pass
             else:
-                print("Server:", e)
+                if self._trace.on:
+                    self._trace.log(T_SERVER, E_ERROR, 0, e.args[0])
                 self._next = self._err
         return have_work
 
-    def _read(self):
+    def _read(self, c):
         have_work = False
         try:
-            x = self._clientsock.recv(1024)
-            if len(x) > 0:
-                self._ibuf += x
-                if self._ibuf.endswith(b"\r\n\r\n"):
-                    self._next = self._process
-                if self._debug > 1:
-                    print("Server: Reading", x)
+            n = _recv_into(c.sock, c.imv[c.ilen:])
+            if n is None:           # EAGAIN - operation would block
+                c.ready = False
+            elif n > 0:
+                if self._trace.on:
+                    self._trace.log(T_SERVER, E_READ, c.ident, n)
+                c.ilen += n
+                c.since = time.ticks_ms()
+                self._frame(c)
+                have_work = True
             else:
-                print("Server: Error: client socket disconnected.")
-                self._ibuf = b""
-                self._next = self._close
-            have_work = True
+                if self._trace.on:
+                    self._trace.log(T_SERVER, E_HANGUP, c.ident)
+                c.next = self._close
+                self._wait(c, 0)
+                have_work = True
         except OSError as e:
             if e.args[0] == 11:     # EAGAIN - operation would block
-                pass
+                c.ready = False
             elif e.args[0] == 110:  # ETIMEDOUT
-                pass
+                c.ready = False
             else:
-                print("Server:", e)
-                self._next = self._err
+                if self._trace.on:
+                    self._trace.log(T_SERVER, E_ERROR, c.ident, e.args[0])
+                c.next = self._close
+                self._wait(c, 0)
         return have_work
 
-    def _process(self):
-        eol = self._ibuf.find(b"\r\n")
-        tokens = self._ibuf[0:eol].split(b" ")
-        if len(tokens) < 2:
-            print("Server: Error: malformed request:", self._ibuf)
-            self._ibuf = b""
-            self._next = self._close
-            return True
-        if self._debug > 0:
-            print("Server: Path:", tokens[1])
-        self._ibuf = b""
-        self._obuf = self._r200
-        self._next = self._write
-        path = tokens[1].split(b"?", 1)
-        qs = b""
-        if len(path) > 1:
-            qs = path[1]
-        path = path[0]
-
-        # Edit out the node number - this is ugly; need a
-        # better way to handle this.
-        #
-        # 0         1         2
-        # 0123456789012345678901234
-        # |           | |     |  |
-        # /uns/nodes/n999_esp/query
-        # /uns/nodes/n999_esp/cmd/
-        # /uns/nodes/n_esp/cmd/
-        # /uns/add/nodes
-        path2 = path[0:12] + path[15:]
-        if path == b"/uns/add/nodes":
-            self._ioq.append(b"A")
-        elif path2 == b"/uns/nodes/n_esp/query":
-            self._ioq.append(b"Q")
-        elif path2 == b"/uns/nodes/n_esp/status":
-            self._ioq.append(b"S")
-        elif path2 == b"/uns/nodes/n_esp/cmd/ST":
-            self._ioq.append(b"S")
-        elif path2.startswith(b"/uns/nodes/n_esp/cmd/"):
-            self._ioq.append(path2[20:])
+    def _frame(self, c):
+        # Decide what the bytes in ibuf amount to: the header is scanned
+        # for only once, resuming where the last read left off, and the
+        # request line and headers are parsed once it is complete.  A
+        # request is complete when its Content-Length body has arrived;
+        # anything after it belongs to the next, pipelined, request.
+        if c.hend == 0:
+            e = _eoh(c.ibuf, c.iscan, c.ilen)
+            c.iscan = c.ilen
+            if e < 0:
+                if c.ilen >= len(c.ibuf):
+                    if self._trace.on:
+                        self._trace.log(T_SERVER, E_RESPONSE, c.ident, 431)
+                    self._reject(c, self._r431)
+                else:
+                    c.next = self._read
+                    self._wait(c, select.POLLIN)
+                return
+            c.hend = e
+            if not self._parse(c):
+                if self._trace.on:
+                    self._trace.log(T_SERVER, E_RESPONSE, c.ident, 400)
+                self._reject(c, self._r400)
+                return
+            if c.hend + c.blen > len(c.ibuf):
+                if self._trace.on:
+                    self._trace.log(T_SERVER, E_RESPONSE, c.ident, 413)
+                self._reject(c, self._r413)
+                return
+        if c.ilen >= c.hend + c.blen:
+            c.next = self._process
+            self._wait(c, 0)
         else:
-            self._obuf = self._r404
-            return True
+            c.next = self._read
+            self._wait(c, select.POLLIN)
+
+    def _parse(self, c):
+        # Request line: <method> SP <path>[?<query>] SP <version> CRLF,
+        # then the headers up to hend.  Only Content-Length and Connection
+        # are of interest.  Returns False if the request is malformed.
+        b = c.ibuf
+        n = c.hend
+        eol = _find(b, 13, 0, n)
+        s1 = _find(b, 32, 0, eol)
+        s2 = _find(b, 32, s1 + 1, eol) if s1 >= 0 else -1
+        if s2 < 0:
+            return False
+        c.path = s1 + 1
+        c.pend = s2
+        c.close = not _equal(b, s2 + 1, eol, b"HTTP/1.1")
+        c.blen = 0
+        i = eol + 2
+        while i < n - 2:
+            e = _find(b, 13, i, n)
+            if e < 0:
+                break
+            if _match(b, i, e, b"content-length:"):
+                c.blen = _int(b, i + 15, e)
+                if c.blen < 0:
+                    return False
+            elif _match(b, i, e, b"connection:"):
+                if _contains(b, i + 11, e, b"close"):
+                    c.close = True
+                elif _contains(b, i + 11, e, b"keep-alive"):
+                    c.close = False
+            i = e + 2
+        return True
+
+    def _respond(self, c, r):
+        c.obuf = r
+        c.obufp = 0
+        c.since = time.ticks_ms()
+        c.next = self._write
+        self._wait(c, select.POLLOUT)
+
+    def _reject(self, c, r):
+        # The rest of the input cannot be trusted, so close after replying
+        c.close = True
+        self._respond(c, r)
+
+    def _finish(self, c):
+        # The response has been sent.  Close, or move any pipelined bytes
+        # that followed this request to the front of ibuf and go on to
+        # the next request.
+        if c.close:
+            c.next = self._close
+            self._wait(c, 0)
+            return
+        b = c.ibuf
+        r = c.hend + c.blen
+        k = c.ilen - r
+        i = 0
+        while i < k:
+            b[i] = b[r + i]
+            i += 1
+        c.ilen = k
+        c.iscan = 0
+        c.hend = 0
+        c.blen = 0
+        c.since = time.ticks_ms()
+        self._frame(c)
+
+    def _process(self, c):
+        b = c.ibuf
+        s2 = c.pend
+        q = _find(b, 63, c.path, s2)    # b"?"
+        if q < 0:
+            q = s2
+        entry = self._route(c, c.path, q)
+        if self._trace.on:
+            self._trace.log(T_SERVER, E_REQUEST, c.ident,
+                            0 if entry is None else entry[0])
+        if self._stats is not None:
+            self._stats.count("server", "requests")
+        if entry is None:
+            if self._stats is not None:
+                self._stats.count("server", "not_found")
+            return self._status(c, 404, self._r404[c.close])
+        if entry[0] == IO_STATS:
+            if self._stats is None:
+                return self._status(c, 404, self._r404[c.close])
+            return self._status(c, 200, self._body(c, b"text/plain",
+                                                   self._stats.render()))
+        if entry[0] == IO_TRACE:
+            return self._hdl_trace(c, entry[1])
+        if self._overloaded is not None and self._overloaded():
+            # Backpressure: the queues are full, so have the ISY retry
+            # later rather than buffer the request
+            if self._stats is not None:
+                self._stats.count("server", "unavailable")
+            return self._status(c, 503, self._r503[c.close])
+        self._status(c, 200, self._r200[c.close])
+        self._ioq.append(entry)
+
+        # Look for a requestId among the query parameters
+        i = q + 1
+        while i < s2:
+            e = _find(b, 38, i, s2)     # b"&"
+            if e < 0:
+                e = s2
+            if e - i > 10 and _equal(b, i, i + 10, b"requestId="):
+                self._ioq.append((IO_RID, bytes(c.imv[i+10:e])))
+            i = e + 1
+        if self._stats is not None:
+            self._stats.high("server", "ioq_high", len(self._ioq))
+        return True
 
-        parms = qs.split(b"&")
-        for p in parms:
-            if p:
-                pl = p.split(b"=")
-                if len(pl) > 1 and pl[0] == b"requestId":
-                    self._ioq.append(b"R" + pl[1])
+    def _status(self, c, status, r):
+        if self._trace.on:
+            self._trace.log(T_SERVER, E_RESPONSE, c.ident, status)
+        self._respond(c, r)
         return True
 
-    def _write(self):
+    def _body(self, c, ctype, body):
+        return memoryview(self._rhdr % (ctype, len(body),
+            b"Connection: close\r\n" if c.close else b"") + body)
+
+    def _hdl_trace(self, c, action):
+        # /uns/trace returns the trace buffer (see unstrace.Trace.dump);
+        # /uns/trace/on, /off and /clear control it.  Without a trace,
+        # all of them are 404.
+        t = self._trace
+        if t is NOTRACE:
+            return self._status(c, 404, self._r404[c.close])
+        if action is None:
+            return self._status(c, 200, self._body(c, b"application/octet-stream",
+                                                   t.dump()))
+        if action == b"on":
+            t.enable(True)
+        elif action == b"off":
+            t.enable(False)
+        elif action == b"clear":
+            t.clear()
+        else:
+            return self._status(c, 404, self._r404[c.close])
+        return self._status(c, 200, self._r200[c.close])
+
+    def _route(self, c, i, n):
+        # Split the path in ibuf[i:n] into segments, then find the first
+        # route that matches them.  Returns the ioq entry, or None.
+        b = c.ibuf
+        segs = self._segs
+        nseg = 0
+        if i >= n or b[i] != 47:        # b"/"
+            return None
+        while i < n:
+            if nseg * 2 >= len(segs):
+                return None
+            e = _find(b, 47, i + 1, n)
+            if e < 0:
+                e = n
+            segs[nseg * 2] = i + 1
+            segs[nseg * 2 + 1] = e
+            nseg += 1
+            i = e
+        for r in self._routes:
+            pat = r[0]
+            if nseg < r[1] or nseg > len(pat):
+                continue
+            k = 0
+            while k < nseg:
+                if pat[k] is not None and not _equal(b, segs[k*2], segs[k*2+1], pat[k]):
+                    break
+                k += 1
+            if k < nseg:
+                continue
+            entry = [r[2]]
+            for k in range(len(pat)):
+                if pat[k] is None:
+                    if k < nseg:
+                        entry.append(bytes(c.imv[segs[k*2]:segs[k*2+1]]))
+                    else:
+                        entry.append(None)
+            return tuple(entry)
+        return None
+
+    def _write(self, c):
         have_work = False
         try:
-            n = self._clientsock.send(self._obuf)
+            if c.obufp == 0:
+                n = c.sock.send(c.obuf)
+            else:
+                n = c.sock.send(c.obuf[c.obufp:])
             if n  > 0:
-                if n < len(self._obuf):
-                    del self._obuf[0:n]
-                else:
-                    self._obuf = b""
-                    self._next = self._close
+                if self._trace.on:
+                    self._trace.log(T_SERVER, E_WRITE, c.ident, n)
+                c.obufp += n
+                c.since = time.ticks_ms()
+                if c.obufp >= len(c.obuf):
+                    c.obuf = None
+                    self._finish(c)
                 have_work = True
             else:
-                print("Server: Error: nothing written to client...")
+                if self._trace.on:
+                    self._trace.log(T_SERVER, E_STALL, c.ident)
         except OSError as e:
             if e.args[0] == 11:     # EAGAIN - operation would block
-                pass
+                c.ready = False
             elif e.args[0] == 110:  # ETIMEDOUT
-                pass
+                c.ready = False
             else:
-                print("Server:", e)
-                self._next = self._err
+                if self._trace.on:
+                    self._trace.log(T_SERVER, E_ERROR, c.ident, e.args[0])
+                c.next = self._close
+                self._wait(c, 0)
         return have_work
 
-    def _close(self):
+    def _close(self, c):
+        try:
+            self._poll.unregister(c.sock)
+        except:
+            pass
         try:
-            self._clientsock.close()
+            c.sock.close()
         except:
             pass
-        self._ibuf = b""
-        self._obuf = b""
-        self._next = self._accept
+        c.sock = None
+        c.obuf = None
+        c.ilen = 0
+        c.iscan = 0
+        c.hend = 0
+        c.blen = 0
+        self._conns.remove(c)
+        self._free.append(c)
+        self._throttle()
+        if self._trace.on:
+            self._trace.log(T_SERVER, E_CLOSE, c.ident, len(self._conns))
         return True
 
 # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = #
 
-class StateMachineClient():
+class _ClientSlot():
 
-    _next = None
+    # Per-request state record for StateMachineClient: one outbound
+    # connection with its own state pointer, buffers and response
+    # parser, so that several requests can be in flight at once.  Like
+    # the buffers, the records are allocated when the client is created.
 
-    _sock = None
+    sock = None
+    next = None
+    keys = None         # ordering keys held while the request is in flight
+    watching = 0        # poll event mask registered for sock
+
+    # Transmit and receive buffers.  Each request is rendered into obuf
+    # by ReportQueue.take(), between "GET " and the header template;
+    # only the response header is kept in ibuf, body bytes are counted
+    # (to find the end of the response) and dropped.
+    obuf = None
+    omv = None
+    olen = 0
+    obufp = 0
+    ibuf = None
+    imv = None
+    ilen = 0
+
+    reused = False      # current request was sent on a held connection
+    keep = False        # hold the connection open after this response
+    inbody = False      # response header has been parsed
+    status = None       # response status code
+    length = -1         # Content-Length still to come (-1 = unknown)
+    chunked = False
+    cst = 0             # chunked body parser state (see _chunks)
+    csize = 0
+
+    deadline = 0        # ticks_ms by which the current stage must finish
+    started = 0         # ticks_us when the current request was started
+    connected = False   # the current attempt got as far as a connection
+    tries = 0           # failed attempts at the current request
+    retry_at = 0        # ticks_ms at which it is tried again
+
+    ident = 0           # number of this slot (from 1), for the trace
+
+    def __init__(self, size, ident):
+        self.ident = ident
+        self.obuf = bytearray(size)
+        self.obuf[0:4] = b"GET "
+        self.omv = memoryview(self.obuf)
+        self.ibuf = bytearray(size)
+        self.imv = memoryview(self.ibuf)
+
+# = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = #
+
+class StateMachineClient():
+
+    _slots = None
+    _busy = None        # ordering keys of the requests in flight
     _addr = None
-    _ibuf = b""
-    _obuf = b""
-    _obufp = 0
-    _rqst = None
+
+    _poll = None        # shared poll object (see unssched.Scheduler)
+
+    _hdr = None         # request header template, after the URL
 
     _restq = None
 
@@ -247,24 +1221,90 @@ class StateMachineClient():
     _isy_auth = None
     _isy_port = None
 
-    _debug = 0
+    # With slots > 1, that many requests are sent at once, each on its
+    # own connection, and all of them are advanced in each run() slice.
+    # ReportQueue.take() picks the requests so that reports for one
+    # driver, and the ordered requests, still reach the ISY in order.
+    #
+    # Keep-alive support: each connection is held open between
+    # requests, and the end of each response is found from its headers
+    # rather than by waiting for the ISY to close the socket.
+    _keepalive = False
+
+    # Delivery: the resolved ISY address is cached until the ISY cannot
+    # be reached.  Connecting, writing and reading each have a deadline.
+    # Failures are of two kinds:
+    #   - The ISY cannot be reached (resolving, connecting).  The request
+    #     is kept and retried after an exponential backoff with jitter;
+    #     after `retries` consecutive failures the circuit opens and
+    #     nothing is sent for `cooldown` ms, after which the same request
+    #     is tried again as a probe.  No new requests are started while
+    #     the last attempt failed, and these requests are never dropped,
+    #     so restq keeps its order across ISY reboots.  Slots failing in
+    #     the same round (before the retry time set by the first) count
+    #     as one failure.
+    #   - The request failed once connected (an error or timeout while
+    #     sending or reading the response, a response we cannot parse,
+    #     or a status other than 2xx).
+    #     That says nothing about the other requests, which carry on.
+    #     The request is retried with the same backoff, and dropped
+    #     after `retries` attempts, so it cannot hold up the queue.
+    _timeouts = None    # (connect, write, read) in ms
+    _retries = 0
+    _backoff = 0        # ms before the first retry; doubles per failure
+    _backoff_max = 0
+    _cooldown = 0       # ms to pause once the circuit opens
+    _fails = 0          # consecutive failed attempts
+    _retry_at = 0       # ticks_ms at which failed requests are retried
 
-    def __init__(self, restq, my_addr, isy_addr, isy_port, isy_auth, debug=0):
-        self._next = self._fetch
+    _stats = None
+    _trace = NOTRACE
+
+    def __init__(self, restq, my_addr, isy_addr, isy_port, isy_auth,
+                 keepalive=False, bufsize=512, slots=1, poller=None,
+                 timeouts=(5000, 5000, 10000), retries=4, backoff=500,
+                 backoff_max=8000, cooldown=60000, stats=None, trace=None):
+        self._stats = stats
+        self._poll = poller
+        self._timeouts = timeouts
+        self._retries = retries
+        self._backoff = backoff
+        self._backoff_max = backoff_max
+        self._cooldown = cooldown
         self._restq = restq
         self._my_addr = my_addr
         self._isy_addr = isy_addr
         self._isy_port = isy_port
         self._isy_auth = isy_auth
-        self._debug = debug
+        self._keepalive = keepalive
+        self._slots = [_ClientSlot(bufsize, i + 1) for i in range(slots)]
+        for c in self._slots:
+            c.next = self._fetch
+        self._busy = []
+        if keepalive:
+            self._hdr = b" HTTP/1.1\r\nHost: " + my_addr + b"\r\nUser Agent: compat\r\nConnection: keep-alive\r\nAuthorization: Basic " + isy_auth + b"\r\n\r\n"
+        else:
+            self._hdr = b" HTTP/1.0\r\nHost: " + my_addr + b"\r\nUser Agent: compat\r\nConnection: close\r\nAuthorization: Basic " + isy_auth + b"\r\n\r\n"
+        if trace is not None:
+            self._trace = trace
         
     def run(self, limit=0):
         have_work = True
-        if limit > 0:
+        if limit > 0 or self._stats is not None:
             start = time.ticks_us()
         while (True):
-            # Execute the next state in the state machine
-            have_work = self._next()
+            # Advance every slot by one state
+            have_work = False
+            for c in self._slots:
+                if self._stats is None:
+                    if c.next(c):
+                        have_work = True
+                else:
+                    f = c.next
+                    t = time.ticks_us()
+                    if f(c):
+                        have_work = True
+                    self._stats.time("client", f.__name__, time.ticks_diff(time.ticks_us(), t))
             # No more work?  No limit? Then we're done.
             if (not have_work) or not (limit > 0):
                 break
@@ -273,129 +1313,426 @@ class StateMachineClient():
             delta = time.ticks_diff(now, start)
             if delta > limit:
                 break
+        if self._stats is not None and limit > 0:
+            self._stats.slice("client", time.ticks_diff(time.ticks_us(), start), limit)
         return have_work
 
-    def _err(self):
+    def idle(self):
+        # True when every queued report has been sent
+        if len(self._restq):
+            return False
+        for c in self._slots:
+            if c.olen > 0:
+                return False
+        return True
+
+    def due(self):
+        # Milliseconds until this client has a deadline or a retry to
+        # act on (0 if overdue), or -1 if it is only waiting for work.
+        t = -1
+        now = time.ticks_ms()
+        for c in self._slots:
+            if c.sock is not None and c.watching:
+                d = time.ticks_diff(c.deadline, now)
+            elif c.olen > 0:
+                d = time.ticks_diff(c.retry_at, now)
+            else:
+                continue
+            if d < 0:
+                d = 0
+            if t < 0 or d < t:
+                t = d
+        return t
+
+    def _err(self, c):
+        # The current attempt failed: drop the connection and schedule
+        # a retry of the same request, or drop the request if it has
+        # failed too often once connected (see Delivery, above).
+        self._watch(c, 0)
         try:
-            if self._sock is not None:
-                self._sock.close()
+            if c.sock is not None:
+                c.sock.close()
         except:
             pass
-        self._sock = None
+        c.sock = None
+        self._reset(c)
+        c.next = self._fetch
+        if self._stats is not None:
+            self._stats.count("client", "errors")
+        if c.connected:
+            c.tries += 1
+            if c.tries >= self._retries:
+                if self._trace.on:
+                    self._trace.log(T_CLIENT, E_DROP, c.ident, c.tries)
+                if self._stats is not None:
+                    self._stats.count("client", "dropped")
+                for k in c.keys:
+                    self._busy.remove(k)
+                c.keys = None
+                c.olen = 0
+                c.tries = 0
+                return True
+            c.retry_at = time.ticks_add(time.ticks_ms(), self._delay(c.tries))
+            return False
         self._addr = None
-        self._rqst = b""
-        self._ibuf = b""
-        self._obuf = b""
-        self._obufp = 0
-        self._next = self._fetch
+        now = time.ticks_ms()
+        if self._fails and time.ticks_diff(now, self._retry_at) < 0:
+            # Another slot has already failed this round; count it once
+            c.retry_at = self._retry_at
+            return False
+        self._fails += 1
+        if self._fails < self._retries:
+            delay = self._delay(self._fails)
+        else:
+            delay = self._cooldown
+            if self._fails == self._retries:
+                if self._trace.on:
+                    self._trace.log(T_CLIENT, E_CIRCUIT, c.ident, delay)
+                if self._stats is not None:
+                    self._stats.count("client", "circuit_open")
+        self._retry_at = time.ticks_add(now, delay)
+        c.retry_at = self._retry_at
         return False
-        
-    def _fetch(self):
-        have_work = False
-        if self._restq:
-            self._rqst = self._restq.pop(0)
-            if self._debug > 1:
-                print("Client: request:", self._rqst)
-            self._obuf = b"GET " + self._rqst +  b" HTTP/1.0\r\nHost: " + self._my_addr + b"\r\nUser Agent: compat\r\nConnection: close\r\nAuthorization: Basic " + self._isy_auth + b"\r\n\r\n"
-            self._obufp = 0
-            self._next = self._open
-            have_work = True
-        return have_work
 
-    def _open(self):
-        self._addr = socket.getaddrinfo(self._isy_addr, self._isy_port)[0][-1]
-        self._sock = socket.socket()
-        self._sock.setblocking(False)
-        self._next = self._connect
+    def _delay(self, n):
+        # Backoff before retry n (from 1), with jitter
+        delay = self._backoff << (n - 1)
+        if delay > self._backoff_max:
+            delay = self._backoff_max
+        return delay + random.getrandbits(16) % (delay // 2 + 1)
+
+    def _until(self, c, stage):
+        # Start the deadline for the next stage of the request
+        c.deadline = time.ticks_add(time.ticks_ms(), self._timeouts[stage])
+
+    def _expired(self, c):
+        if time.ticks_diff(time.ticks_ms(), c.deadline) < 0:
+            return False
+        if self._trace.on:
+            self._trace.log(T_CLIENT, E_TIMEOUT, c.ident)
+        c.next = self._err
+        return True
+
+    def _watch(self, c, event):
+        # Register the event the current state is waiting for with the
+        # shared poller, so the main loop can sleep until it happens.
+        # The socket is unregistered (0) whenever no request is active.
+        if self._poll is None or event == c.watching:
+            return
+        if event:
+            if c.watching:
+                self._poll.modify(c.sock, event)
+            else:
+                self._poll.register(c.sock, event)
+        else:
+            try:
+                self._poll.unregister(c.sock)
+            except:
+                pass
+        c.watching = event
+
+    def _reset(self, c):
+        # Prepare to (re)send the rendered request and read its response
+        c.obufp = 0
+        c.ilen = 0
+        c.inbody = False
+        c.status = None
+        c.length = -1
+        c.chunked = False
+        c.cst = 0
+        c.csize = 0
+
+    def _reconnect(self, c):
+        # The held connection was closed by the ISY before (or while) we
+        # sent the request.  Drop it and send the request again on a
+        # fresh connection.
+        if self._trace.on:
+            self._trace.log(T_CLIENT, E_RECONNECT, c.ident)
+        self._watch(c, 0)
+        try:
+            c.sock.close()
+        except:
+            pass
+        c.sock = None
+        c.reused = False
+        self._reset(c)
+        c.next = self._open
+        return True
+
+    def _fetch(self, c):
+        if c.olen > 0:
+            # A failed request is waiting to be retried
+            now = time.ticks_ms()
+            if (time.ticks_diff(now, c.retry_at) < 0 or (self._fails > 0 and
+                    time.ticks_diff(now, self._retry_at) < 0)):
+                return False
+            c.reused = False
+            c.next = self._open
+            return True
+        if not self._restq or self._fails > 0:
+            return False
+        n = len(self._restq)
+        x = self._restq.take(self._busy, c.obuf, 4)
+        if x is None:
+            return False
+        if self._stats is not None:
+            self._stats.high("client", "restq_high", n)
+        c.started = time.ticks_us()
+        if self._trace.on:
+            self._trace.log(T_CLIENT, E_REQUEST, c.ident, n)
+        c.olen = _put(c.obuf, x[0], self._hdr)
+        if c.olen < 0:
+            if self._trace.on:
+                self._trace.log(T_CLIENT, E_TOOLONG, c.ident)
+            c.olen = 0
+            return True
+        c.keys = x[1]
+        self._busy.extend(c.keys)
+        self._reset(c)
+        if c.sock is not None:
+            c.reused = True
+            c.connected = True
+            self._watch(c, select.POLLOUT)
+            self._until(c, 1)
+            c.next = self._write
+        else:
+            c.reused = False
+            c.next = self._open
         return True
 
-    def _connect(self):
+    def _open(self, c):
+        c.connected = False
+        try:
+            if self._addr is None:
+                self._addr = socket.getaddrinfo(self._isy_addr, self._isy_port)[0][-1]
+            c.sock = socket.socket()
+        except OSError as e:
+            if self._trace.on:
+                self._trace.log(T_CLIENT, E_ERROR, c.ident, e.args[0])
+            c.next = self._err
+            return True
+        c.sock.setblocking(False)
+        self._watch(c, select.POLLOUT)
+        self._until(c, 0)
+        c.next = self._connect
+        return True
+
+    def _connect(self, c):
         have_work = False
         try:
-            self._sock.connect(self._addr)
-            self._next = self._write
+            c.sock.connect(self._addr)
+            c.connected = True
+            self._until(c, 1)
+            c.next = self._write
             have_work = True
         except OSError as e:
             if e.args[0] == 110:    # ETIMEDOUT   - will get this on first call
-                pass
+                self._expired(c)
             elif e.args[0] == 115:  # EINPROGRESS - may get this on second
-                pass
+                self._expired(c)
             elif e.args[0] == 114:  # EALREADY    - (already) connected
-                self._next = self._write
+                c.connected = True
+                self._until(c, 1)
+                c.next = self._write
             else:
-                print("Client:", e)
-                self._next = self._err
+                if self._trace.on:
+                    self._trace.log(T_CLIENT, E_ERROR, c.ident, e.args[0])
+                c.next = self._err
         return have_work
 
-    def _write(self):
+    def _write(self, c):
         have_work = False
         try:
-            n = self._sock.send(self._obuf[self._obufp:])
+            n = c.sock.send(c.omv[c.obufp:c.olen])
             if n  > 0:
-                if self._debug > 1:
-                    print("Client: Writing", self._obuf[self._obufp:n])
-                self._obufp += n
-                if self._obufp >= len(self._obuf):
-                    self._next = self._read
+                if self._trace.on:
+                    self._trace.log(T_CLIENT, E_WRITE, c.ident, n)
+                c.obufp += n
+                if c.obufp >= c.olen:
+                    self._watch(c, select.POLLIN)
+                    self._until(c, 2)
+                    c.next = self._read
                 have_work = True
             else:
-                print("Client: Error: nothing written to client...")
+                if self._trace.on:
+                    self._trace.log(T_CLIENT, E_STALL, c.ident)
         except OSError as e:
             if e.args[0] == 11:     # EAGAIN - operation would block
-                pass
+                self._expired(c)
             elif e.args[0] == 110:  # ETIMEDOUT
-                pass
+                self._expired(c)
+            elif c.reused:          # EPIPE, ECONNRESET, ... on held socket
+                have_work = self._reconnect(c)
             else:
-                print("Client:", e)
-                self._next = self._err
+                if self._trace.on:
+                    self._trace.log(T_CLIENT, E_ERROR, c.ident, e.args[0])
+                c.next = self._err
         return have_work
 
-    def _read(self):
+    def _read(self, c):
         have_work = False
         try:
-            x = self._sock.recv(256)
-            if len(x) > 0:
-                self._ibuf += x
-                if self._debug > 1:
-                    print("Client: Reading", x)
+            n = _recv_into(c.sock, c.imv[c.ilen:])
+            if n is None:           # EAGAIN - operation would block
+                self._expired(c)
+            elif n > 0:
+                if self._trace.on:
+                    self._trace.log(T_CLIENT, E_READ, c.ident, n)
+                c.ilen += n
+                if self._complete(c, n):
+                    c.next = self._process
+                elif not c.inbody and c.ilen >= len(c.ibuf):
+                    if self._trace.on:
+                        self._trace.log(T_CLIENT, E_TOOLONG, c.ident, c.ilen)
+                    c.next = self._err
                 have_work = True
             else:
-                if len(self._ibuf) > 0:
-                    self._next = self._process
+                if c.inbody or c.ilen > 0:
+                    # Response delimited by the ISY closing the socket
+                    c.keep = False
+                    c.next = self._process
                     have_work = True
+                elif c.reused:
+                    have_work = self._reconnect(c)
                 else:
-                    print("Client: No data to read yet...")
+                    if self._trace.on:
+                        self._trace.log(T_CLIENT, E_HANGUP, c.ident)
+                    c.next = self._err
         except OSError as e:
             if e.args[0] == 11:     # EAGAIN - operation would block
-                pass
+                self._expired(c)
             elif e.args[0] == 110:  # ETIMEDOUT
-                pass
+                self._expired(c)
+            elif c.reused and not c.inbody and c.ilen == 0:
+                have_work = self._reconnect(c)
             else:
-                print("Client:", e)
-                self._next = self._err
+                if self._trace.on:
+                    self._trace.log(T_CLIENT, E_ERROR, c.ident, e.args[0])
+                c.next = self._err
         return have_work
 
-    def _process(self):
-        eol = self._ibuf.find(b"\r\n")
-        tokens = self._ibuf[0:eol].split(b" ")
-        if len(tokens) < 2:
-            print("Client: Error: malformed response:", self._ibuf)
-        else:
-            if self._debug > 0:
-                print("Client: {}: {}".format(int(tokens[1]), self._rqst))
-        self._next = self._close
+    def _complete(self, c, n):
+        # Decide whether the whole response has arrived, using the
+        # Content-Length or chunked framing from the headers.  Without
+        # either, the response ends when the ISY closes the socket.
+        # n is the number of bytes just added to ibuf.
+        i = 0
+        if not c.inbody:
+            i = _eoh(c.ibuf, c.ilen - n, c.ilen)
+            if i < 0:
+                return False
+            self._headers(c, i)
+            c.inbody = True
+        done = False
+        if c.chunked:
+            done = self._chunks(c, i, c.ilen)
+        elif c.length >= 0:
+            c.length -= c.ilen - i
+            done = c.length <= 0
+        c.ilen = 0                  # body bytes are not kept
+        return done
+
+    def _headers(self, c, end):
+        # Parse the status line and the framing headers in place
+        b = c.ibuf
+        eol = _find(b, 10, 0, end)
+        c.status = _int(b, _find(b, 32, 0, eol) + 1, eol)
+        if c.status < 0:
+            c.status = None
+        c.keep = self._keepalive and _match(b, 0, eol, b"http/1.1")
+        i = eol + 1
+        while i < end:
+            eol = _find(b, 10, i, end)
+            if _match(b, i, eol, b"content-length:"):
+                c.length = _int(b, i + 15, eol)
+            elif _match(b, i, eol, b"transfer-encoding:"):
+                c.chunked = _contains(b, i + 18, eol, b"chunked")
+            elif _match(b, i, eol, b"connection:"):
+                if _contains(b, i + 11, eol, b"close"):
+                    c.keep = False
+                elif _contains(b, i + 11, eol, b"keep-alive"):
+                    c.keep = self._keepalive
+            i = eol + 1
+        if not (c.chunked or c.length >= 0):
+            c.keep = False
+
+    def _chunks(self, c, i, n):
+        # Run the chunked body parser over ibuf[i:n]; True at the end of
+        # the body.  States: 0 chunk size, 1 rest of size line, 2 chunk
+        # data, 3 end of chunk data, 4 start of trailer line, 5 trailer.
+        b = c.ibuf
+        while i < n:
+            ch = b[i]
+            st = c.cst
+            if st == 0:
+                if ch == 10:
+                    st = 4 if c.csize == 0 else 2
+                elif ch == 13 or ch == 59:  # CR or ';'
+                    st = 1
+                else:
+                    ch = ch - 48 if ch < 58 else (ch | 32) - 87
+                    c.csize = c.csize * 16 + ch
+            elif st == 1:
+                if ch == 10:
+                    st = 4 if c.csize == 0 else 2
+            elif st == 2:
+                k = n - i
+                if k > c.csize:
+                    k = c.csize
+                c.csize -= k
+                i += k
+                if c.csize == 0:
+                    st = 3
+                c.cst = st
+                continue
+            elif st == 3:
+                if ch == 10:
+                    st = 0
+            elif st == 4:
+                if ch == 10:
+                    return True
+                if ch != 13:
+                    st = 5
+            elif ch == 10:
+                st = 4
+            c.cst = st
+            i += 1
+        return False
+
+    def _process(self, c):
+        # The ISY answered, so it can be reached; anything but a 2xx
+        # is a failed request, retried and then dropped by _err()
+        self._fails = 0
+        if self._stats is not None:
+            self._stats.count("client", "requests")
+            self._stats.time("client", "request_rtt",
+                             time.ticks_diff(time.ticks_us(), c.started))
+        if self._trace.on:
+            self._trace.log(T_CLIENT, E_RESPONSE, c.ident,
+                            0 if c.status is None else c.status)
+        if c.status is None or c.status < 200 or c.status > 299:
+            c.next = self._err
+            return True
+        c.tries = 0
+        c.next = self._close
         return True
 
-    def _close(self):
-        try:
-            self._sock.close()
-        except:
-            pass
-        self._ibuf = b""
-        self._obuf = b""
-        self._rqst = b""
-        self._obufp = 0
-        self._next = self._fetch
+    def _close(self, c):
+        self._watch(c, 0)
+        if not c.keep:
+            try:
+                c.sock.close()
+            except:
+                pass
+            c.sock = None
+            if self._trace.on:
+                self._trace.log(T_CLIENT, E_CLOSE, c.ident)
+        for k in c.keys:
+            self._busy.remove(k)
+        c.keys = None
+        c.olen = 0
+        self._reset(c)
+        c.next = self._fetch
         return True
 
 # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = #
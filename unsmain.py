@@ -30,238 +30,101 @@
 #
 # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = #
 
-import dht
 import gc
-import machine
 import utime as time
 from unslib import *
+from unsnode import *
+from unsio import *
+from unssched import *
+from unssensor import *
+from unsstats import *
+from unstrace import *
 
 # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = #
 
-class HandleIO():
-
-    _ioq = None
-    _restq = None
-
-    _success = True
-
-    _ticks = None
-    _secs  = None
-    _dsecs = None
-    _mins  = None
-    _9mins = None
-
-    _drivers = {'ST' : [0, 51, None],  # Percentage
-                'GV1': [0,  2, None],  # On/Off
-                'GV2': [0,  2, None],  # On/Off
-                'GV3': [0,  2, None],  # On/Off
-                'GV4': [0,  2, None],  # On/Off
-                'GV5': [0, 56, None],  # Int8
-                'GV6': [0, 56, None],  # Int8
-                'GV7': [0, 56, None],  # Int8
-                'GV8': [0, 56, None],  # Int8
-                'GV9': [0, 56, None]}  # Int32
-    _led1 = None
-    _led2 = None
-    _dht = None
-    _btn = None
-
-    _btn_value = 0
-    _btn_on = False
-    _send_btn_command = False
-
-    _debug = 0
-
-    def __init__(self, ioq, restq, debug=0):
-        self._restq = restq
-        self._ioq = ioq
-        self._debug = debug
-        self._led1 = machine.PWM(machine.Pin(15), freq=1000)
-        self._led1.duty(0)
-        self._led2 = machine.Pin(2, machine.Pin.OUT)
-        self._led2.value(0)
-        self._dht = dht.DHT11(machine.Pin(4))
-        self._btn = machine.Pin(12, machine.Pin.IN, machine.Pin.PULL_UP)
-        
-    def run(self):
-        # Start by handling the input queue
-        if self._ioq:
-            inp = self._ioq.pop(0)
-            if self._debug > 0:
-                print("IO: input operation:", inp)
-            if inp == b"S":
-                self._hdl_qs(False)
-            elif inp == b"Q":
-                self._hdl_qs(True)
-            elif inp == b"A":
-                self._hdl_add()
-            elif inp[0] == 47:  # b"/"
-                self._hdl_cmd(inp)
-            elif inp[0] == 82:  # b"R"
-                # TODO: correctly handle response
-                self._hdl_rid(inp)
-            else:
-                print("IO: Error: unknown request", inp[0])
-
-        # Update the ISY on startup
-        if self._ticks is None:
-            self._hdl_qs(False)
-
-        # Handle I/O devices no more often than every 10ms
-        ticks = time.ticks_ms()
-        if self._ticks is None or (time.ticks_diff(ticks, self._ticks) > 10):
-            self._ticks = ticks
-            b = self._btn.value()
-            if b != self._btn_value:
-                # We have a button state change
-                if b == 0:
-                    # Button changed to "pressed"
-                    if self._debug > 1:
-                        print("IO: button pressed, sending command...")
-                    self._send_btn_command = True
-                self._btn_value = b
-
-        # Handle 1s I/O pin polling here... (995ms to stagger events)
-        if self._secs is None or (time.ticks_diff(ticks, self._secs) > 995):
-            self._secs = ticks
-            if self._send_btn_command:
-                self._send_btn_command = False
-                p = b"/rest/ns/3/nodes/n003_esp/report/cmd/CA"
-                self._restq.append(p)
-                
-        # Handle 10s I/O pin polling here... (stagger +103ms here)
-        if self._dsecs is None or (time.ticks_diff(ticks, self._dsecs) > 10103):
-            self._dsecs = ticks
-            self._read_dht(send_report=True)
-
-        # Handle 60s I/O pin polling here... (stagger +207 ms)
-        if self._mins is None or (time.ticks_diff(ticks, self._mins) > 60207):
-            self._mins = ticks
-
-        # Handle 9m Heartbeat polling here... (stagger -333 ms)
-        if self._9mins is None or (time.ticks_diff(ticks, self._9mins) > ((60000*9)-333)):
-            self._9mins = ticks
-            p = b"/rest/ns/3/nodes/n003_esp/report/cmd/CB"
-            self._restq.append(p)
-
-        # Set LED1 based on the command
-        self._led1.duty(int(self._drivers['ST'][0] * 10.23))
-
-        # Set LED2 based on the command
-        self._led2.value(self._drivers['GV1'][0])
-
-    def _read_dht(self, send_report=False):
-        self._dht.measure()
-        self._drivers['GV6'][0] = int(((self._dht.temperature()*9)/5)+32)
-        self._drivers['GV7'][0] = self._dht.humidity()
-        if send_report:
-            self._report('GV6')
-            self._report('GV7')
-
-    def _hdl_qs(self, is_query):
-        if is_query:
-            self._read_dht(send_report=False)
-        for key in self._drivers.keys():
-            self._report(key, force=is_query)
-        
-    def _report(self, k, force=False):
-        v = self._drivers[k][0]
-        o = self._drivers[k][2]
-        if (force) or (o is None) or (v != o):
-            u = self._drivers[k][1]
-            p = b"/rest/ns/3/nodes/n003_esp/report/status/{}/{}/{}".format(k,v,u)
-            if self._debug > 1:
-                print("IO: _report: restq.append({})".format(p))
-            self._restq.append(p)
-            self._drivers[k][2] = v
+debug = 0
+
+# Server, client, IO, spill, sensor and snapshot diagnostics go to a ring
+# buffer rather than the console; fetch it from /uns/trace and decode it
+# with dectrace.
+trace = Trace(128, on=True)
+
+ioq = RingQueue(64)
+# One request per driver status; batch > 1 is experimental (see ReportQueue)
+restq = ReportQueue(b"/rest/ns/3", batch=1,
+                    spill=SpillQueue("restq.spl", 16384, trace=trace), high=32,
+                    size=64)
+
+stats = Stats()
+sched = Scheduler()
+budget = Budget(ioq, restq, frame=3000, ioq_high=32, restq_high=24,
+                spill_high=75, stats=stats)
+sensors = Sensors(sched, stats=stats, trace=trace)
+io_handler = HandleIO(ioq, restq, sched, sensors, state="state.bin",
+                      trace=trace, debug=debug)
+rest_server = StateMachineServer(ioq, 8300, maxconn=4,
+                                 poller=sched.poller(),
+                                 overloaded=budget.overloaded, stats=stats,
+                                 trace=trace)
+rest_client = StateMachineClient(restq, b"192.168.1.200",
+                                 b"192.168.1.62", 80,
+                                 b"your-base64-encoded-id-pw-string",
+                                 keepalive=True, slots=2,
+                                 poller=sched.poller(),
+                                 stats=stats, trace=trace)
 
-    def _hdl_add(self):
-        p = b"/rest/ns/3/nodes/n003_esp/add/ESP_MAIN?primary=n003_esp&name=esp8266"
-        self._restq.append(p)
+freemem = 0
 
-    def _hdl_rid(self, inp):
-        rid = inp[1:]
-        # [TODO] figure out how to handle success/fail...
-        if self._success:
-            p = b"/rest/ns/3/report/request/" + rid + b"/success"
-        else:
-            p = b"/rest/ns/3/report/request/" + rid + b"/failed"
-        if self._debug > 1:
-            print("IO: _rid: restq.append({})".format(p))
-        self._restq.append(p)
+def log_mem():
+    global freemem
+    f = gc.mem_free()
+    if f != freemem and trace.on:
+        trace.log(T_MAIN, E_MEM, 0, f)
+        freemem = f
 
-    def _hdl_cmd(self, inp):
-        cl = inp.split(b"/")
-        cm = cl[1]
-        if self._debug > 0:
-            print('IO: command is {}'.format(cm))
-        report = None
-        if cm == b'C1':
-            if self._drivers['ST'][0] < 100:
-                self._drivers['ST'][0] += 1
-                report = 'ST'
-        elif cm == b'C2':
-            if self._drivers['ST'][0] > 0:
-                self._drivers['ST'][0] -= 1
-                report = 'ST'
-        elif cm == b'C3':
-            self._drivers['GV1'][0] = 1
-            report = 'GV1'
-        elif cm == b'C4':
-            self._drivers['GV1'][0] = 0
-            report = 'GV1'
-        elif cm == b'DOF':
-            self._drivers['ST'][0] = 0
-            report = 'ST'
-        elif cm == b'DON':
-            if len(cl) > 2:
-                self._drivers['ST'][0] = int(cl[2])
-            else:
-                self._drivers['ST'][0] = 100
-            report = 'ST'
+sched.every(60000, log_mem)
 
-        # Send report for affected driver value
-        if report is not None:
-            self._report(report)
+gc_policy = GCPolicy(stats=stats)
 
-# = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = #
+# Boot-to-ready time: ticks_ms() counts from reset, so its value once
+# the server is listening and the startup reports have gone out is the
+# time the node server took to come up.  It shows in /uns/stats.
+stats.set("boot", "main_ms", time.ticks_ms())
 
-debug = 1
+def boot_ready():
+    if rest_server.listening() and rest_client.idle():
+        t = time.ticks_ms()
+        stats.set("boot", "ready_ms", t)
+        if trace.on:
+            trace.log(T_MAIN, E_READY, 0, t)
+        sched.cancel(ready_task)
 
-ioq = []
-restq = []
-
-io_handler = HandleIO(ioq, restq, debug=debug)
-rest_server = StateMachineServer(ioq, 8300, debug=debug)
-rest_client = StateMachineClient(restq, b"192.168.1.200",
-                                 b"192.168.1.62", 80,
-                                 b"your-base64-encoded-id-pw-string",
-                                 debug=debug)
-
-tcks = None
-freemem = 0
-
-gc.collect()
+ready_task = sched.every(50, boot_ready)
 
 try:
+    slept = False
     while True:
-        rest_server.run(limit=1000)
-        rest_client.run(limit=1000)
-        io_handler.run()
-
-        gc.collect()
-
-        if debug > 0:
-            now = time.ticks_ms()
-            if (tcks is None) or (time.ticks_diff(now, tcks) > 60000):
-                f = gc.mem_free()
-                if f != freemem:
-                    print("Free memory:", f)
-                    freemem = f
-                tcks = now
+        # Share out this pass by how much work each part has waiting
+        budget.plan(rest_server.active(), slept)
+        busy = rest_server.run(limit=budget.server)
+        busy = rest_client.run(limit=budget.client) or busy
+        busy = io_handler.run(limit=budget.io) or busy
+        busy = sched.run() or busy
+
+        # Nothing left to do: take any sensor samples that are due,
+        # collect garbage if it is worth it, then sleep until the next
+        # timer or socket event
+        if not busy:
+            busy = sensors.sample()
+        slept = not busy
+        if not busy:
+            gc_policy.idle(sched.next_due())
+            sched.idle(rest_client.due())
 
 except KeyboardInterrupt:
     print("Exiting...")
+    io_handler.save()
+    trace.save("trace.bin")
 
 # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = #
 # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = #
@@ -0,0 +1,585 @@
+# unsnode.py
+#
+# = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = #
+#
+# MIT License
+#
+# Copyright (c) 2017 Mike Westerhof
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = #
+
+import uarray as array
+import uos as os
+import utime as time
+from unslib import *
+from unstrace import *
+
+# = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = #
+
+# Bytes per driver value in the node value arrays
+_VSIZE = len(bytes(array.array("l", [0])))
+
+# Driver layouts shared by all nodes with the same driver spec:
+#   {spec: (driver ids, array of uoms, {driver id: slot})}
+_layouts = {}
+
+class Policy():
+
+    # How changes to a driver are reported to the ISY.  A new value is
+    # first smoothed over the last window samples (their mean, or their
+    # median), then only counts as a change if it has moved by at least
+    # deadband, or by percent of the value last sent, whichever is more.
+    # Changes are reported no more than once per min_ms, the latest one
+    # being sent when the interval is up, and the value is reported
+    # again every max_ms even if it has not changed.  Zero disables a
+    # setting.  A policy holds no state and may be shared between
+    # drivers and nodes.
+
+    deadband = 0
+    percent = 0
+    min_ms = 0
+    max_ms = 0
+    window = 0
+    median = False
+
+    def __init__(self, deadband=0, percent=0, min_ms=0, max_ms=0,
+                 window=0, median=False):
+        self.deadband = deadband
+        self.percent = percent
+        self.min_ms = min_ms
+        self.max_ms = max_ms
+        self.window = window
+        self.median = median
+
+    def smooth(self, w, v):
+        # w is [samples array, count, next index]; add v and return the
+        # smoothed value
+        buf = w[0]
+        buf[w[2]] = v
+        w[2] = (w[2] + 1) % len(buf)
+        if w[1] < len(buf):
+            w[1] += 1
+        n = w[1]
+        if self.median:
+            return sorted(buf[:n])[n // 2]
+        return (sum(buf[:n]) + n // 2) // n
+
+    def changed(self, v, sent):
+        band = self.deadband
+        if self.percent:
+            p = abs(sent) * self.percent // 100
+            if p > band:
+                band = p
+        if band == 0:
+            return v != sent
+        return v - sent >= band or sent - v >= band
+
+# = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = #
+
+class Node():
+
+    # One ISY node hosted by this device: its address, node-def id and
+    # driver table, and the commands it accepts.  Subclasses fill in
+    # _cmds, usually with commands(), which maps a command id to the
+    # function handling it and the range its parameter must be in; the
+    # function is called as f(node, value, uom), with value and uom as
+    # received (bytes or None), and returns False if it failed.
+    #
+    # Drivers are addressed by slot, their position in the spec of
+    # (driver id, uom) pairs given to the constructor.  The ids, uoms
+    # and the id to slot index are shared by every node with that spec;
+    # each node only holds its current and last-sent values, in arrays,
+    # and a bitmap of slots that need reporting.  Drivers given a Policy
+    # also keep the time they were last reported and their samples.
+
+    _addr = None
+    _nodedef = None
+    _name = None
+    _primary = None
+    _nodes = None       # NodeRegistry this node has been added to
+
+    _ids = None         # driver ids, by slot
+    _uoms = None        # driver uoms, by slot
+    _index = None       # {driver id: slot}
+    _value = None       # current driver values
+    _sent = None        # driver values last reported to the ISY
+    _dirty = 0          # bitmap: value differs from _sent, or never sent
+    _unsent = 0         # bitmap: value never sent
+
+    _hold = False       # reports are being held back (see hold())
+    _held = 0           # bitmap: slots with a report held back
+
+    _policy = None      # Policy by slot, or None if no slot has one
+    _when = None        # ticks_ms of the last report, by slot
+    _window = None      # {slot: [samples, count, next]} for smoothing
+
+    _cmds = {}
+    _coalesce = ()      # commands that only set drivers (see NodeRegistry)
+
+    def __init__(self, addr, nodedef, name, drivers, primary=None):
+        self._addr = addr
+        self._nodedef = nodedef
+        self._name = name
+        self._primary = addr if primary is None else primary
+        layout = _layouts.get(drivers)
+        if layout is None:
+            if len(drivers) > 30:
+                raise ValueError("too many drivers")
+            ids = tuple(d[0] for d in drivers)
+            index = {}
+            for i in range(len(ids)):
+                index[ids[i]] = i
+            layout = (ids, array.array("H", [d[1] for d in drivers]), index)
+            _layouts[drivers] = layout
+        self._ids, self._uoms, self._index = layout
+        n = len(drivers)
+        self._value = array.array("l", [0] * n)
+        self._sent = array.array("l", [0] * n)
+        self._dirty = self._unsent = (1 << n) - 1
+
+    def slot(self, k):
+        return self._index[k]
+
+    def policy(self, i, policy):
+        # Apply a reporting Policy to the driver in slot i; call before
+        # the node is added to the NodeRegistry
+        if self._policy is None:
+            n = len(self._ids)
+            self._policy = [None] * n
+            self._when = array.array("l", [0] * n)
+            self._window = {}
+        self._policy[i] = policy
+        self._when[i] = time.ticks_ms()
+        if policy.window > 1:
+            self._window[i] = [array.array("l", [0] * policy.window), 0, 0]
+
+    def get(self, i):
+        return self._value[i]
+
+    def set(self, i, v, report=True):
+        b = 1 << i
+        p = None if self._policy is None else self._policy[i]
+        if p is None:
+            changed = v != self._sent[i]
+        else:
+            w = self._window.get(i)
+            if w is not None:
+                v = p.smooth(w, v)
+            changed = p.changed(v, self._sent[i])
+        self._value[i] = v
+        if changed or self._unsent & b:
+            self._dirty |= b
+        else:
+            self._dirty &= ~b
+        if report and self._dirty & b:
+            if self._hold:
+                self._held |= b
+            elif (p is None or not p.min_ms or self._unsent & b or
+                    time.ticks_diff(time.ticks_ms(), self._when[i]) >= p.min_ms):
+                self.report(i)
+
+    def report(self, i, force=False):
+        # Queue a status report for the driver in slot i if it changed
+        # since the last one (or unconditionally, if forced)
+        b = 1 << i
+        if force or self._dirty & b:
+            v = self._value[i]
+            self._nodes._status(self, self._ids[i], v, self._uoms[i])
+            self._sent[i] = v
+            self._dirty &= ~b
+            self._unsent &= ~b
+            if self._policy is not None:
+                self._when[i] = time.ticks_ms()
+
+    def report_all(self, force=False):
+        if force:
+            for i in range(len(self._ids)):
+                self.report(i, force=True)
+            return
+        # Only visit the slots that need reporting
+        d = self._dirty
+        i = 0
+        while d:
+            if d & 1:
+                self.report(i)
+            d >>= 1
+            i += 1
+
+    def hold(self):
+        # Hold back reports from set() until release(), so that a run of
+        # changes to a driver is reported once, with its final value
+        self._hold = True
+
+    def release(self):
+        self._hold = False
+        d = self._held & self._dirty
+        self._held = 0
+        i = 0
+        while d:
+            if d & 1:
+                self.report(i)
+            d >>= 1
+            i += 1
+
+    def report_due(self):
+        # Send the changes held back by a minimum interval once it is up,
+        # and the reports that are due again under a maximum interval
+        now = time.ticks_ms()
+        for i in range(len(self._policy)):
+            p = self._policy[i]
+            if p is None:
+                continue
+            t = time.ticks_diff(now, self._when[i])
+            if self._dirty & (1 << i) and t >= p.min_ms:
+                self.report(i)
+            elif p.max_ms and t >= p.max_ms:
+                self.report(i, force=True)
+
+    def send_cmd(self, cmd):
+        self._nodes._command(self, cmd)
+
+    def query(self):
+        # Called before a full report in answer to a query; nodes with
+        # inputs that are only sampled occasionally refresh them here.
+        pass
+
+    def command(self, cmd, value, uom):
+        e = self._cmds.get(cmd)
+        if e is None or not _valid(e[1], value, uom):
+            return False
+        return e[0](self, value, uom) is not False
+
+def commands(cls, accepts):
+    # Fill in a Node subclass's _cmds from a generated <ID>_ACCEPTS table
+    # (see mkconsts), binding each command to the method named _cmd_ and
+    # the command id in lower case.  A command the profile accepts but
+    # the class does not handle is an error now, not when it is sent.
+    cmds = {}
+    for cmd, rng in accepts:
+        f = getattr(cls, "_cmd_" + cmd.decode().lower(), None)
+        if f is None:
+            raise ValueError("no handler for command " + cmd.decode())
+        cmds[cmd] = (f, rng)
+    cls._cmds = cmds
+
+def _valid(rng, value, uom):
+    # Check a command parameter against its editor's (uom, min, max,
+    # subset) range, as given in the profile
+    if rng is None or value is None:
+        return True
+    try:
+        v = int(value)
+        if uom is not None and int(uom) != rng[0]:
+            return False
+    except ValueError:
+        return False
+    if rng[3] is not None:
+        return v in rng[3]
+    return (rng[1] is None or v >= rng[1]) and (rng[2] is None or v <= rng[2])
+
+# = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = #
+
+class NodeRegistry():
+
+    # All the nodes hosted by this device.  Applies the operations the
+    # StateMachineServer places on the ioq to the node they address,
+    # and builds the node server to ISY requests placed on the restq.
+
+    _ioq = None
+    _restq = None
+
+    _nodes = None       # in the order they were added; primaries first
+    _index = None       # {addr: node}
+    _timed = None       # nodes with reporting policies
+
+    _success = True     # outcome of the last operation, for requestId
+    _changed = False    # a report was queued since the last Snapshot
+    _watch = None       # called when _changed is set (see Snapshot)
+
+    _trace = NOTRACE
+
+    def __init__(self, ioq, restq, trace=None):
+        self._ioq = ioq
+        self._restq = restq
+        if trace is not None:
+            self._trace = trace
+        self._nodes = []
+        self._index = {}
+        self._timed = []
+
+    def add(self, node):
+        node._nodes = self
+        self._nodes.append(node)
+        self._index[node._addr] = node
+        if node._policy is not None:
+            self._timed.append(node)
+        return node
+
+    def get(self, addr):
+        return self._index.get(addr)
+
+    def report_all(self, force=False):
+        for node in self._nodes:
+            node.report_all(force=force)
+
+    def report_due(self):
+        # Call periodically (once a second is plenty) to apply the
+        # reporting policies' intervals
+        for node in self._timed:
+            node.report_due()
+
+    def run(self):
+        # Handle one entry from the input queue
+        if not self._ioq:
+            return False
+        inp = self._ioq.pop(0)
+        op = inp[0]
+        if self._trace.on:
+            self._trace.log(T_IO, E_INPUT, op, len(self._ioq))
+        if op == IO_ADD:
+            self._hdl_add()
+        elif op == IO_QUERY:
+            self._hdl_qs(op, inp[1], True)
+        elif op == IO_STATUS:
+            self._hdl_qs(op, inp[1], False)
+        elif op == IO_CMD:
+            node = self._index.get(inp[1])
+            if node is not None and inp[2] in node._coalesce:
+                self._hdl_cmds(node, inp)
+            else:
+                self._hdl_cmd(inp)
+        elif op == IO_RID:
+            self._hdl_rid(inp)
+        elif op == IO_INSTALL or op == IO_REPORT:
+            self._success = True
+        else:
+            if self._trace.on:
+                self._trace.log(T_IO, E_BADOP, op)
+            self._success = False
+        return True
+
+    def _node(self, op, addr):
+        node = self._index.get(addr)
+        if node is None and self._trace.on:
+            self._trace.log(T_IO, E_NONODE, op)
+        return node
+
+    def _hdl_add(self):
+        for node in self._nodes:
+            self._restq.add(node._addr, node._nodedef, node._primary, node._name)
+            if self._trace.on:
+                self._trace.log(T_IO, E_REQUEST, RQ_ADD, len(self._restq))
+        self._success = True
+
+    def _hdl_qs(self, op, addr, is_query):
+        node = self._node(op, addr)
+        self._success = node is not None
+        if node is not None:
+            if is_query:
+                node.query()
+            node.report_all(force=is_query)
+
+    def _hdl_cmd(self, inp):
+        cm = inp[2]
+        if cm == b"ST":
+            self._hdl_qs(IO_CMD, inp[1], False)
+            return
+        node = self._node(IO_CMD, inp[1])
+        self._success = node is not None
+        if node is not None:
+            self._success = node.command(cm, inp[3], inp[4])
+
+    def _hdl_cmds(self, node, inp):
+        # Apply a run of commands for one node together: this one, and
+        # any that follow it in the ioq, interleaved with their request
+        # IDs, as long as they are in the node's _coalesce set.  Reports
+        # are held until the end, so a burst of C1/C2 nets out to one
+        # ST report, and DON/DOF to the last one; every request ID is
+        # still acknowledged, after the report, with its own outcome.
+        node.hold()
+        self._success = node.command(inp[2], inp[3], inp[4])
+        acks = []
+        n = 1
+        q = self._ioq
+        while q:
+            x = q[0]
+            if x[0] == IO_RID:
+                acks.append((x[1], self._success))
+            elif x[0] == IO_CMD and x[1] == node._addr and x[2] in node._coalesce:
+                self._success = node.command(x[2], x[3], x[4])
+                n += 1
+            else:
+                break
+            q.pop(0)
+        node.release()
+        if self._trace.on and n > 1:
+            self._trace.log(T_IO, E_COALESCE, 0, n)
+        for rid, ok in acks:
+            self._ack(rid, ok)
+
+    def _hdl_rid(self, inp):
+        self._ack(inp[1], self._success)
+
+    def _ack(self, rid, ok):
+        self._restq.ack(rid, ok)
+        if self._trace.on:
+            self._trace.log(T_IO, E_REQUEST, RQ_ACK, len(self._restq))
+
+    def _status(self, node, k, v, u):
+        self._restq.report(node._addr, k, v, u)
+        if self._trace.on:
+            self._trace.log(T_IO, E_REQUEST, RQ_STATUS, len(self._restq))
+        if not self._changed:
+            self._changed = True
+            if self._watch is not None:
+                self._watch()
+
+    def _command(self, node, cmd):
+        self._restq.command(node._addr, cmd)
+        if self._trace.on:
+            self._trace.log(T_IO, E_REQUEST, RQ_CMD, len(self._restq))
+
+# = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = #
+
+class Snapshot():
+
+    # Keeps the driver values of every node in the registry in a file,
+    # so that after a restart (a brownout, say) the nodes resume where
+    # they were instead of reporting every driver to the ISY again.
+    #
+    # save() is called delay ms after the first report queued since the
+    # last one, so the file is at most a few seconds behind what the ISY
+    # was sent (a restored _sent that is older than that would keep a
+    # value the ISY no longer has from being reported again), while a
+    # burst of reports still costs the flash a single write.
+    # restore() must be called after the nodes are added and before the
+    # startup report; nodes whose address, node-def or drivers (ids, in
+    # slot order, and uoms) no longer match the file are left as they
+    # are, so a profile change cannot put values in the wrong slots.
+    # The file starts with MAGIC, then holds, for each node, its
+    # address, node-def and comma-separated driver ids (each length
+    # prefixed), driver count, unsent bitmap, and the uom, current and
+    # last-sent value arrays.
+
+    MAGIC = b"UNS\x02"
+
+    _nodes = None
+    _path = None
+    _sched = None
+    _delay = 0
+
+    _trace = NOTRACE
+
+    def __init__(self, nodes, path, sched, delay=5000, trace=None):
+        self._nodes = nodes
+        self._path = path
+        self._sched = sched
+        self._delay = delay
+        if trace is not None:
+            self._trace = trace
+        nodes._watch = self._schedule
+
+    def _schedule(self):
+        self._sched.after(self._delay, self.flush)
+
+    def flush(self):
+        if self._nodes._changed:
+            self.save()
+
+    def save(self):
+        self._nodes._changed = False
+        tmp = self._path + ".tmp"
+        try:
+            with open(tmp, "wb") as f:
+                f.write(self.MAGIC)
+                for node in self._nodes._nodes:
+                    ids = b",".join(node._ids)
+                    f.write(bytes((len(node._addr),)))
+                    f.write(node._addr)
+                    f.write(bytes((len(node._nodedef),)))
+                    f.write(node._nodedef)
+                    f.write(bytes((len(ids),)))
+                    f.write(ids)
+                    f.write(bytes((len(node._ids),)))
+                    f.write(node._unsent.to_bytes(4, "little"))
+                    f.write(node._uoms)
+                    f.write(node._value)
+                    f.write(node._sent)
+            os.rename(tmp, self._path)
+        except OSError as e:
+            if self._trace.on:
+                self._trace.log(T_STATE, E_ERROR, 0, e.args[0])
+            return
+        if self._trace.on:
+            self._trace.log(T_STATE, E_SAVED, 0, len(self._nodes._nodes))
+
+    def restore(self):
+        # Returns the number of nodes restored
+        try:
+            f = open(self._path, "rb")
+        except OSError:
+            return 0
+        n = 0
+        with f:
+            if f.read(len(self.MAGIC)) != self.MAGIC:
+                if self._trace.on:
+                    self._trace.log(T_STATE, E_CORRUPT, 0)
+                return 0
+            while True:
+                addr = self._field(f)
+                nodedef = self._field(f)
+                ids = self._field(f)
+                k = f.read(1)
+                unsent = f.read(4)
+                if (addr is None or nodedef is None or ids is None or
+                        len(k) < 1 or len(unsent) < 4):
+                    break
+                k = k[0]
+                uoms = f.read(k * 2)
+                node = self._nodes.get(addr)
+                if (node is None or node._nodedef != nodedef or
+                        len(node._ids) != k or ids != b",".join(node._ids) or
+                        uoms != bytes(node._uoms)):
+                    f.read(k * 2 * _VSIZE)
+                    continue
+                if (f.readinto(node._value) != k * _VSIZE or
+                        f.readinto(node._sent) != k * _VSIZE):
+                    if self._trace.on:
+                        self._trace.log(T_STATE, E_CORRUPT, 1, n)
+                    node._dirty = node._unsent = (1 << k) - 1
+                    break
+                node._unsent = int.from_bytes(unsent, "little")
+                node._dirty = node._unsent
+                for i in range(k):
+                    if node._value[i] != node._sent[i]:
+                        node._dirty |= 1 << i
+                n += 1
+        if self._trace.on:
+            self._trace.log(T_STATE, E_RESTORED, 0, n)
+        return n
+
+    def _field(self, f):
+        b = f.read(1)
+        if len(b) < 1:
+            return None
+        return f.read(b[0])
+
+# = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = #
@@ -0,0 +1,44 @@
+# unsprofile.py
+#
+# Generated by mkconsts from the profile XML - do not edit.
+
+from micropython import const
+
+PROFILE_VERSION = b"0.0.2"
+
+# = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = #
+
+ESP_MAIN = b"ESP_MAIN"
+
+ESP_MAIN_ST = const(0)
+ESP_MAIN_GV1 = const(1)
+ESP_MAIN_GV2 = const(2)
+ESP_MAIN_GV3 = const(3)
+ESP_MAIN_GV4 = const(4)
+ESP_MAIN_GV5 = const(5)
+ESP_MAIN_GV6 = const(6)
+ESP_MAIN_GV7 = const(7)
+ESP_MAIN_GV8 = const(8)
+ESP_MAIN_GV9 = const(9)
+
+ESP_MAIN_DRIVERS = (
+    (b"ST", 51),
+    (b"GV1", 2),
+    (b"GV2", 2),
+    (b"GV3", 2),
+    (b"GV4", 2),
+    (b"GV5", 56),
+    (b"GV6", 56),
+    (b"GV7", 56),
+    (b"GV8", 56),
+    (b"GV9", 56),
+)
+
+ESP_MAIN_ACCEPTS = (
+    (b"DON", (51, 0, 100, None)),
+    (b"DOF", None),
+    (b"C1", None),
+    (b"C2", None),
+    (b"C3", None),
+    (b"C4", None),
+)
@@ -0,0 +1,355 @@
+# unssched.py
+#
+# = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = #
+#
+# MIT License
+#
+# Copyright (c) 2017 Mike Westerhof
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = #
+
+import gc
+import uselect as select
+import utime as time
+
+# = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = #
+
+class Task():
+
+    # A function the Scheduler calls once at (or after) its deadline,
+    # and then every period milliseconds if period is non-zero.
+
+    fn = None
+    period = 0
+    deadline = 0
+
+    def __init__(self, fn, period, deadline):
+        self.fn = fn
+        self.period = period
+        self.deadline = deadline
+
+# = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = #
+
+class Scheduler():
+
+    # Runs timed tasks from a binary heap ordered by deadline, and lets
+    # the main loop sleep until the next deadline or until one of the
+    # sockets registered with its poller is ready, instead of spinning.
+    #
+    # Deadlines are utime.ticks_ms() values, so they are compared with
+    # ticks_diff() to cope with wrap-around; that keeps the heap ordered
+    # as long as no task is scheduled more than half the ticks period
+    # ahead, which is days.
+
+    _tasks = None
+    _poll = None
+    _latency = 0        # longest idle() sleep between wake() checks (0 = none)
+    _woken = False
+
+    def __init__(self):
+        self._tasks = []
+        self._poll = select.poll()
+
+    def poller(self):
+        # The poll object the main loop sleeps on.  State machines
+        # register their sockets with it while waiting for I/O.
+        return self._poll
+
+    def set_latency(self, ms):
+        # Interrupt handlers cannot cut a poll() short, so idle() sleeps
+        # in slices of at most ms and returns early once one of them has
+        # called wake().  The shortest latency asked for wins.
+        if self._latency == 0 or ms < self._latency:
+            self._latency = ms
+
+    def wake(self):
+        # Safe to call from an interrupt handler: nothing is allocated
+        self._woken = True
+
+    def every(self, period, fn, delay=0):
+        # Call fn every period ms, the first time after delay ms
+        t = Task(fn, period, time.ticks_add(time.ticks_ms(), delay))
+        self._push(t)
+        return t
+
+    def after(self, delay, fn):
+        # Call fn once, after delay ms
+        t = Task(fn, 0, time.ticks_add(time.ticks_ms(), delay))
+        self._push(t)
+        return t
+
+    def cancel(self, t):
+        if t in self._tasks:
+            self._tasks.remove(t)
+            self._heapify()
+
+    def run(self):
+        # Call every task that is due.  Periodic tasks keep their phase
+        # unless they have fallen a whole period behind.
+        have_work = False
+        now = time.ticks_ms()
+        while self._tasks and time.ticks_diff(self._tasks[0].deadline, now) <= 0:
+            t = self._pop()
+            if t.period > 0:
+                t.deadline = time.ticks_add(t.deadline, t.period)
+                if time.ticks_diff(t.deadline, now) <= 0:
+                    t.deadline = time.ticks_add(now, t.period)
+                self._push(t)
+            t.fn()
+            have_work = True
+        return have_work
+
+    def next_due(self):
+        # Milliseconds until the next task is due (0 if overdue), or -1
+        # if there are no tasks.
+        if not self._tasks:
+            return -1
+        t = time.ticks_diff(self._tasks[0].deadline, time.ticks_ms())
+        return t if t > 0 else 0
+
+    def idle(self, limit=-1):
+        # Sleep until the next task is due or a registered socket is
+        # ready, but no longer than limit ms (if limit >= 0).
+        t = self.next_due()
+        if limit >= 0 and (t < 0 or t > limit):
+            t = limit
+        if t != 0 and not self._woken:
+            if self._latency == 0:
+                self._poll.poll(t)
+            else:
+                start = time.ticks_ms()
+                while True:
+                    s = self._latency
+                    if t > 0:
+                        left = t - time.ticks_diff(time.ticks_ms(), start)
+                        if left <= 0:
+                            break
+                        if left < s:
+                            s = left
+                    if self._poll.poll(s) or self._woken:
+                        break
+        self._woken = False
+
+    def _less(self, i, j):
+        return time.ticks_diff(self._tasks[i].deadline, self._tasks[j].deadline) < 0
+
+    def _swap(self, i, j):
+        h = self._tasks
+        h[i], h[j] = h[j], h[i]
+
+    def _push(self, t):
+        self._tasks.append(t)
+        i = len(self._tasks) - 1
+        while i > 0:
+            p = (i - 1) >> 1
+            if not self._less(i, p):
+                break
+            self._swap(i, p)
+            i = p
+
+    def _pop(self):
+        h = self._tasks
+        t = h[0]
+        last = h.pop()
+        if h:
+            h[0] = last
+            self._sift(0)
+        return t
+
+    def _sift(self, i):
+        n = len(self._tasks)
+        while True:
+            c = 2 * i + 1
+            if c >= n:
+                break
+            if c + 1 < n and self._less(c + 1, c):
+                c += 1
+            if not self._less(c, i):
+                break
+            self._swap(c, i)
+            i = c
+
+    def _heapify(self):
+        i = (len(self._tasks) >> 1) - 1
+        while i >= 0:
+            self._sift(i)
+            i -= 1
+
+# = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = #
+
+class GCPolicy():
+
+    # Decides when to run gc.collect(), instead of running it on every
+    # pass of the main loop.  MicroPython's own allocation threshold
+    # (gc.threshold) bounds how much can be allocated between
+    # collections while the loop is busy.  When it goes idle, idle() is
+    # given the time until the next scheduled task and collects if
+    # enough has been allocated since the last collection and the
+    # window is long enough - or at once if free heap is below the low
+    # watermark.  The duration of each collection and the memory it
+    # freed are recorded.
+
+    _threshold = 0      # bytes allocated before an automatic collection
+    _idle_bytes = 0     # bytes allocated before an idle collection
+    _low = 0            # free heap watermark that forces a collection
+    _window = 0         # shortest idle window (ms) to collect in
+
+    _alloc = 0          # gc.mem_alloc() just after the last collection
+
+    count = 0           # collections run by this policy
+    total_us = 0        # time spent in them
+    last_us = 0
+    max_us = 0
+    last_freed = 0      # bytes freed by the last one
+
+    _stats = None
+
+    def __init__(self, threshold=8192, idle_bytes=1024, low=8192, window=5,
+                 stats=None):
+        self._stats = stats
+        self._threshold = threshold
+        self._idle_bytes = idle_bytes
+        self._low = low
+        self._window = window
+        if threshold > 0:
+            gc.threshold(threshold)
+        self.collect()
+
+    def idle(self, window):
+        # window is the time in ms until the next task is due (-1 if
+        # none).  Returns True if a collection was run.
+        if gc.mem_free() < self._low:
+            self.collect()
+            return True
+        if window >= 0 and window < self._window:
+            return False
+        if gc.mem_alloc() - self._alloc < self._idle_bytes:
+            return False
+        self.collect()
+        return True
+
+    def collect(self):
+        before = gc.mem_free()
+        start = time.ticks_us()
+        gc.collect()
+        dt = time.ticks_diff(time.ticks_us(), start)
+        self._alloc = gc.mem_alloc()
+        self.count += 1
+        self.total_us += dt
+        self.last_us = dt
+        if dt > self.max_us:
+            self.max_us = dt
+        self.last_freed = gc.mem_free() - before
+        if self._stats is not None:
+            self._stats.time("gc", "collect", dt)
+            self._stats.set("gc", "freed", self.last_freed)
+            self._stats.set("gc", "free", gc.mem_free())
+
+# = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = #
+
+class Budget():
+
+    # Divides each pass of the main loop between the server, the IO
+    # handler and the client, and tells the server when to push back.
+    #
+    # plan() is called at the top of every pass.  It splits a frame of
+    # up to frame us in proportion to the work waiting for each part:
+    # the server's open connections (plus one, so it always gets a
+    # share), the ioq and the restq.  No part gets less than floor us.
+    # If passes have recently been taking longer than the frame, so
+    # that sockets and timers are waiting on us, the frame shrinks in
+    # proportion until they catch up.
+    #
+    # The queues have high watermarks.  Once either is exceeded,
+    # overloaded() is True until both have drained below half their
+    # watermark, and the server answers 503 rather than queue more.
+    # The watermark is there to save memory, so for the restq it applies
+    # to the entries held in RAM, not to those spilled to flash; set it
+    # below the restq's own high watermark, so the server pushes back
+    # before entries start spilling.  The spill file is watched too,
+    # since it drops its oldest records once full: spill_high is the
+    # percentage of it in use past which the server pushes back.
+
+    server = 1000       # us slices for this pass
+    io = 1000
+    client = 1000
+
+    _ioq = None
+    _restq = None
+    _frame = 3000
+    _floor = 200
+    _ioq_high = 32
+    _restq_high = 24
+    _spill_high = 75
+
+    _lat = 0            # moving average of the pass time (us)
+    _last = 0           # ticks_us at the start of the last pass
+    _over = False
+
+    _stats = None
+
+    def __init__(self, ioq, restq, frame=3000, floor=200, ioq_high=32,
+                 restq_high=24, spill_high=75, stats=None):
+        self._ioq = ioq
+        self._restq = restq
+        self._frame = frame
+        self._floor = floor
+        self._ioq_high = ioq_high
+        self._restq_high = restq_high
+        self._spill_high = spill_high
+        self._stats = stats
+        self._last = time.ticks_us()
+
+    def plan(self, conns, slept=False):
+        # conns is the number of open server connections; slept is True
+        # if the last pass ended by sleeping, which says nothing about
+        # how long the work took
+        now = time.ticks_us()
+        if not slept:
+            dt = time.ticks_diff(now, self._last)
+            self._lat += (dt - self._lat) >> 3
+        self._last = now
+        frame = self._frame
+        if self._lat > frame:
+            frame = frame * frame // self._lat
+        ws = conns + 1
+        wi = len(self._ioq)
+        wc = len(self._restq)
+        w = ws + wi + wc
+        self.server = max(self._floor, frame * ws // w)
+        self.io = max(self._floor, frame * wi // w)
+        self.client = max(self._floor, frame * wc // w)
+        if self._stats is not None:
+            self._stats.set("budget", "pass_us", self._lat)
+
+    def overloaded(self):
+        ni = len(self._ioq)
+        nr = self._restq.ram_len()
+        ns = self._restq.spill_used()
+        if self._over:
+            self._over = (ni > self._ioq_high // 2 or nr > self._restq_high // 2
+                          or ns > self._spill_high // 2)
+        else:
+            self._over = (ni > self._ioq_high or nr > self._restq_high
+                          or ns > self._spill_high)
+        return self._over
+
+# = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = #
@@ -0,0 +1,171 @@
+# unssensor.py
+#
+# = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = #
+#
+# MIT License
+#
+# Copyright (c) 2017 Mike Westerhof
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = #
+
+import utime as time
+from unstrace import *
+
+# = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = #
+
+# Sensor states
+_IDLE = 0           # waiting for the next period
+_DUE = 1            # period elapsed, start() not yet called
+_BUSY = 2           # started, waiting for the conversion to finish
+_READY = 3          # conversion finished, read() not yet called
+
+class Sensor():
+
+    # Base class for sensor drivers.  A driver overrides read(), and
+    # start() if the device has to be triggered and then given time to
+    # convert before it can be read (a DS18B20, say):
+    #
+    #   start()   begin a measurement; return the ms to wait before read()
+    #   read()    return a tuple of values, or None if the sample failed
+    #
+    # Sensors calls these from the main loop when it has nothing else to
+    # do, so a driver may block briefly, but no longer than it must.
+    # The last good reading is cached with the time it was taken.
+
+    name = "sensor"
+    period = 10000      # ms between samples
+    stale = 30000       # ms after which the cached reading is too old
+
+    _state = _IDLE
+    _values = None
+    _stamp = 0
+    _on_sample = None
+
+    def start(self):
+        return 0
+
+    def read(self):
+        return None
+
+    def values(self):
+        # The cached reading, or None if there has never been one
+        return self._values
+
+    def age(self):
+        # ms since the cached reading was taken, or -1 if there is none
+        if self._values is None:
+            return -1
+        return time.ticks_diff(time.ticks_ms(), self._stamp)
+
+    def fresh(self):
+        a = self.age()
+        return 0 <= a <= self.stale
+
+# = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = #
+
+class Sensors():
+
+    # Samples sensors on their own schedules, off the request path.
+    # When a sensor's period elapses it is only marked due; sample() does
+    # the work, one step of one sensor per call, and the main loop calls
+    # it when it would otherwise sleep.  If the loop stays busy for a
+    # whole period the sensor is sampled from the scheduler instead, so
+    # readings cannot starve.  Each good reading is passed to the
+    # on_sample(values) callback given to add().  Trace records name a
+    # sensor by its position in the order they were added.
+
+    _sched = None
+    _sensors = None
+
+    _stats = None
+    _trace = NOTRACE
+
+    def __init__(self, sched, stats=None, trace=None):
+        self._sched = sched
+        self._sensors = []
+        self._stats = stats
+        if trace is not None:
+            self._trace = trace
+
+    def add(self, sensor, on_sample, delay=0):
+        sensor._on_sample = on_sample
+        self._sensors.append(sensor)
+        self._sched.every(sensor.period, lambda: self._due(sensor), delay)
+        return sensor
+
+    def refresh(self, sensor):
+        # Ask for a sample as soon as the loop is idle, e.g. because a
+        # query found the cached reading stale
+        if sensor._state == _IDLE:
+            sensor._state = _DUE
+
+    def sample(self):
+        # Advance the first sensor with work to do.  Returns have_work.
+        for s in self._sensors:
+            if s._state == _DUE:
+                self._step(s)
+                return True
+            if s._state == _READY:
+                self._read(s)
+                return True
+        return False
+
+    def _due(self, s):
+        if s._state == _IDLE:
+            s._state = _DUE
+        elif s._state != _BUSY:
+            # Still waiting since the last period: don't wait any longer
+            if self._trace.on:
+                self._trace.log(T_SENSOR, E_OVERDUE, self._sensors.index(s))
+            if s._state == _DUE:
+                self._step(s)
+            else:
+                self._read(s)
+
+    def _step(self, s):
+        ms = s.start()
+        if ms > 0:
+            s._state = _BUSY
+            self._sched.after(ms, lambda: self._ready(s))
+        else:
+            self._read(s)
+
+    def _ready(self, s):
+        s._state = _READY
+
+    def _read(self, s):
+        s._state = _IDLE
+        t = time.ticks_us()
+        v = s.read()
+        if self._stats is not None:
+            self._stats.time("sensor", s.name, time.ticks_diff(time.ticks_us(), t))
+        if v is None:
+            if self._stats is not None:
+                self._stats.count("sensor", "errors")
+            if self._trace.on:
+                self._trace.log(T_SENSOR, E_NOREAD, self._sensors.index(s))
+            return
+        s._values = v
+        s._stamp = time.ticks_ms()
+        if s._on_sample is not None:
+            s._on_sample(v)
+
+# = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = #
@@ -0,0 +1,138 @@
+# unsstats.py
+#
+# = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = #
+#
+# MIT License
+#
+# Copyright (c) 2017 Mike Westerhof
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = #
+
+import gc
+import utime as time
+
+# = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = #
+
+class Stats():
+
+    # Runtime counters, gauges, high-watermarks and latency histograms,
+    # grouped by component ("server", "client", "gc", ...), and served
+    # as plain text by StateMachineServer on /uns/stats.  One line per
+    # value, "<group>.<name> <value>"; histograms are rendered as
+    # "<group>.<name> n=<count> p50=<us> p99=<us> max=<us>".
+    #
+    # A histogram counts samples in power-of-two buckets of
+    # microseconds, so p50/p99 are upper bounds within a factor of two.
+    # Lookups use two levels of dicts with constant keys, so recording
+    # a value does not allocate once the entry exists.
+
+    NBUCKETS = 24       # up to 2^24 us (~17 s); larger go in the last
+
+    _values = None      # {group: {name: value}}
+    _hists = None       # {group: {name: [count, max, bucket0, ...]}}
+    _start = 0
+
+    def __init__(self):
+        self._values = {}
+        self._hists = {}
+        self._start = time.ticks_ms()
+
+    def _group(self, d, group):
+        g = d.get(group)
+        if g is None:
+            g = d[group] = {}
+        return g
+
+    def count(self, group, name, n=1):
+        g = self._group(self._values, group)
+        g[name] = g.get(name, 0) + n
+
+    def set(self, group, name, v):
+        self._group(self._values, group)[name] = v
+
+    def high(self, group, name, v):
+        g = self._group(self._values, group)
+        if v > g.get(name, 0):
+            g[name] = v
+
+    def time(self, group, name, us):
+        g = self._group(self._hists, group)
+        h = g.get(name)
+        if h is None:
+            h = g[name] = [0] * (self.NBUCKETS + 2)
+        h[0] += 1
+        if us > h[1]:
+            h[1] = us
+        b = 0
+        while us > 1 and b < self.NBUCKETS - 1:
+            us >>= 1
+            b += 1
+        h[b + 2] += 1
+
+    def slice(self, group, used, limit):
+        # Record a run(limit=...) slice: time used against the limit
+        self.count(group, "slices")
+        self.count(group, "slice_us", used)
+        self.count(group, "limit_us", limit)
+        if used > limit:
+            self.count(group, "overruns")
+
+    def render(self):
+        out = ["uptime_ms %d" % time.ticks_diff(time.ticks_ms(), self._start),
+               "mem.free %d" % gc.mem_free(),
+               "mem.alloc %d" % gc.mem_alloc(),
+               "mem.largest %d" % self._largest()]
+        for group, g in self._values.items():
+            for name, v in g.items():
+                out.append("%s.%s %d" % (group, name, v))
+        for group, g in self._hists.items():
+            for name, h in g.items():
+                out.append("%s.%s n=%d p50=%d p99=%d max=%d" % (
+                    group, name, h[0], self._pct(h, 50), self._pct(h, 99), h[1]))
+        out.append("")
+        return "\n".join(out).encode()
+
+    def _pct(self, h, p):
+        # Upper bound of the bucket holding the p'th percentile sample
+        need = (h[0] * p + 99) // 100
+        n = 0
+        for b in range(self.NBUCKETS):
+            n += h[b + 2]
+            if n >= need:
+                return 1 << (b + 1)
+        return h[1]
+
+    def _largest(self):
+        # Size of the largest block that can be allocated, found by
+        # bisection; only done when the stats are rendered.
+        lo = 0
+        hi = gc.mem_free()
+        while hi - lo > 64:
+            mid = (lo + hi) // 2
+            try:
+                b = bytearray(mid)
+                b = None
+                lo = mid
+            except MemoryError:
+                hi = mid
+        return lo
+
+# = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = #
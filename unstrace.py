@@ -0,0 +1,156 @@
+# unstrace.py
+#
+# = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = #
+#
+# MIT License
+#
+# Copyright (c) 2017 Mike Westerhof
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = #
+
+import ustruct as struct
+import utime as time
+from micropython import const
+
+# = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = #
+#
+# Components, and the events they record.  dectrace reads these tables from
+# this file to decode a dump, so add new ones in the same form.  Each event
+# has an argument (arg) and a value (val); for the server and client the
+# argument is the connection or slot number unless noted.
+
+T_MAIN = const(0)
+T_SERVER = const(1)
+T_CLIENT = const(2)
+T_SPILL = const(3)
+T_IO = const(4)
+T_SENSOR = const(5)
+T_STATE = const(6)
+
+E_LISTEN = const(1)         # server listening          val: port
+E_ACCEPT = const(2)         # connection accepted       val: open connections
+E_READ = const(3)           # bytes received            val: count
+E_WRITE = const(4)          # bytes sent                val: count
+E_REQUEST = const(5)        # request queued or sent    val: opcode or queue length
+E_RESPONSE = const(6)       # response status           val: HTTP status
+E_CLOSE = const(7)          # connection closed         val: open connections
+E_IDLE = const(8)           # idle connection closed    val: ms idle
+E_HANGUP = const(9)         # peer closed unexpectedly
+E_ERROR = const(10)         # socket or file error      val: errno
+E_TIMEOUT = const(11)       # deadline passed
+E_RECONNECT = const(12)     # held connection dropped by the ISY
+E_CIRCUIT = const(13)       # ISY unreachable, pausing  val: ms
+E_TOOLONG = const(14)       # request too long          val: bytes, if known
+E_STALL = const(15)         # send() wrote nothing
+E_FULL = const(16)          # full, oldest dropped      val: records held
+E_MEM = const(17)           # free heap changed         val: bytes
+E_READY = const(18)         # boot to ready             val: ms
+E_DROP = const(19)          # request dropped           val: attempts
+E_INPUT = const(20)         # ioq entry handled         arg: opcode, val: entries left
+E_COALESCE = const(21)      # commands applied together val: count
+E_BADOP = const(22)         # unknown ioq entry         arg: opcode
+E_NONODE = const(23)        # entry for an unknown node arg: opcode
+E_OVERDUE = const(24)       # sample still pending      arg: sensor
+E_NOREAD = const(25)        # sensor gave no reading    arg: sensor
+E_SAVED = const(26)         # snapshot written          val: nodes
+E_RESTORED = const(27)      # snapshot read             val: nodes restored
+E_CORRUPT = const(28)       # snapshot unreadable       arg: 0 format, 1 truncated
+E_BUTTON = const(29)        # button pressed
+
+# = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = #
+
+class Trace():
+
+    # A ring buffer of fixed-size event records, for diagnostics that
+    # do not disturb the timing they are meant to show.  A record is
+    # RECSIZE bytes: ticks_us (u32), component (u8), event (u8), arg
+    # (u16) and val (i32), packed into a buffer allocated up front, so
+    # logging an event neither allocates nor does any I/O.  Once the
+    # buffer is full the oldest records are overwritten.
+    #
+    # Callers test `on` before calling log(), so a disabled trace costs
+    # one attribute lookup per event.  enable() turns it on and off at
+    # runtime (StateMachineServer does so on /uns/trace/on and /off).
+    #
+    # dump() returns the records oldest first after a HEADER, and save()
+    # writes the same to a file; dectrace decodes either on a host.
+
+    FORMAT = "<IBBHi"
+    RECSIZE = 12
+    HEADER = "<4sBBHII"         # magic, version, RECSIZE, records, ticks period, now
+    MAGIC = b"UNST"
+    VERSION = 1
+
+    on = False
+
+    _buf = None
+    _size = 0           # records the buffer holds
+    _next = 0           # index of the record written next
+    _full = False       # the buffer has wrapped
+
+    def __init__(self, size=256, on=False):
+        self._size = size
+        self._buf = bytearray(size * self.RECSIZE)
+        self.enable(on)
+
+    def enable(self, on=True):
+        self.on = on and self._size > 0
+
+    def clear(self):
+        self._next = 0
+        self._full = False
+
+    def log(self, comp, ev, arg=0, val=0):
+        i = self._next
+        struct.pack_into(self.FORMAT, self._buf, i * self.RECSIZE,
+                         time.ticks_us(), comp, ev, arg & 0xffff, val)
+        i += 1
+        if i == self._size:
+            i = 0
+            self._full = True
+        self._next = i
+
+    def __len__(self):
+        return self._size if self._full else self._next
+
+    def dump(self):
+        # The records, oldest first, after a header.  Allocates a copy,
+        # so events logged while it is sent are not lost.
+        n = len(self)
+        k = self._next * self.RECSIZE
+        # ticks_add(0, -1) is the largest tick, so the decoder knows
+        # where the timestamps wrap
+        h = struct.pack(self.HEADER, self.MAGIC, self.VERSION, self.RECSIZE,
+                        n, time.ticks_add(0, -1), time.ticks_us())
+        out = bytearray(h)
+        if self._full:
+            out.extend(memoryview(self._buf)[k:])
+        out.extend(memoryview(self._buf)[:k])
+        return out
+
+    def save(self, path):
+        with open(path, "wb") as f:
+            f.write(self.dump())
+
+# A trace that is never on, for components given none
+NOTRACE = Trace(0)
+
+# = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = # = = #